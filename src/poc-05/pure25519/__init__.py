@@ -5,7 +5,12 @@ import os
 
 from .basic import (bytes_to_clamped_scalar,
                     bytes_to_scalar, scalar_to_bytes,
-                    bytes_to_element, Base)
+                    bytes_to_element, bytes_to_unknown_group_element,
+                    multiscalarmult_elements, double_scalarmult_base,
+                    negate_element,
+                    bytes_to_unknown_group_elements, encode_points,
+                    double_element, add_elements, is_extended_zero,
+                    precompute_base, Base, Zero, L)
 
 # adapt pure25519/ed25519.py to behave like (C/glue) ed25519/_ed25519.py, so
 # ed25519_oop.py doesn't have to change
@@ -58,13 +63,21 @@ def publickey(seed32):
     vk32 = A.to_bytes()
     return vk32, seed32+vk32
 
-def sign(msg, skvk):
+def publickeys(seeds):
+    # bulk version of publickey(), sharing one inversion for all keys
+    As = [Base.scalarmult(bytes_to_clamped_scalar(H(s)[:32])).XYTZ
+          for s in seeds]
+    return [(vk32, s+vk32) for s, vk32 in zip(seeds, encode_points(As))]
+
+def expand(skvk):
+    # the secret scalar and the nonce prefix, derived from the seed
+    h = H(skvk[:32])
+    return bytes_to_clamped_scalar(h[:32]), h[32:]
+
+def sign(msg, skvk, expanded=None):
     assert len(skvk) == 64
-    sk = skvk[:32]
     vk = skvk[32:]
-    h = H(sk[:32])
-    a_bytes, inter = h[:32], h[32:]
-    a = bytes_to_clamped_scalar(a_bytes)
+    a, inter = expanded if expanded else expand(skvk)
     r = Hint(inter + msg)
     R = Base.scalarmult(r)
     R_bytes = R.to_bytes()
@@ -72,27 +85,127 @@ def sign(msg, skvk):
     sig = R_bytes + scalar_to_bytes(S)
     return sig + msg
 
-def open(sigmsg, vk):
+def sign_many(msgs, skvk, expanded=None):
+    # signs each message like sign(), but encodes all R with a single
+    # inversion; returns the list of detached signatures
+    assert len(skvk) == 64
+    vk = skvk[32:]
+    a, inter = expanded if expanded else expand(skvk)
+    rs = [Hint(inter + msg) for msg in msgs]
+    Rs = encode_points([Base.scalarmult(r).XYTZ for r in rs])
+    return [R_bytes + scalar_to_bytes(r + Hint(R_bytes + vk + msg) * a)
+            for r, R_bytes, msg in zip(rs, Rs, msgs)]
+
+def _is_small_order(pt): # extended -> True if [8]pt is Zero
+    for i in range(3):
+        pt = double_element(pt)
+    return is_extended_zero(pt)
+
+# Signatures are checked with the cofactored equation [8]([S]B-[h]A-R)==0,
+# by open() and by verify_batch() alike (as in Zcash's ZIP 215): a batch
+# cannot check the cofactorless [S]B-[h]A==R for each R without a costly
+# subgroup check per R. The two equations differ only for an R with a
+# small-order component, which only the holder of the signing key can
+# make. The accelerated backends (cofactorless) are adapted, see crypto.py
+
+def open(sigmsg, vk, A=None):
+    # A: optional, the already decoded vk (see VerifyingKey.element())
     assert len(vk) == 32
     sig = sigmsg[:64]
     msg = sigmsg[64:]
     try:
-        R = bytes_to_element(sig[:32])
-        A = bytes_to_element(vk)
+        # R needs no subgroup check, thanks to the cofactor
+        R = bytes_to_unknown_group_element(sig[:32])
+        if A is None:
+            A = bytes_to_element(vk)
         S = bytes_to_scalar(sig[32:])
+        if S >= L: # non-canonical, as rejected by libsodium and OpenSSL
+            raise ValueError("S is not reduced")
         h = Hint(sig[:32] + vk + msg)
-        v1 = Base.scalarmult(S)
-        v2 = R.add(A.scalarmult(h))
+        # [S]B - [h]A == R, computed as one joint double-scalar mult
+        v = double_scalarmult_base(S, h % L, negate_element(A.XYTZ))
     except ValueError as e:
         raise BadSignatureError(e)
     except Exception as e:
         if str(e) == "decoding point that is not on curve":
             raise BadSignatureError(e)
         raise
-    if v1 != v2:
+    if not _is_small_order(add_elements(v, negate_element(R.XYTZ))):
         raise BadSignatureError()
     return msg
 
+def verify_batch(items, entropy=os.urandom):
+    # items is a list of (vk, sig, msg) tuples, returns a list of booleans.
+    # vk can be the 32B key or a VerifyingKey (whose decoded point is used).
+    # All signatures are checked at once with a random linear combination
+    # of the (cofactored, see above) verification equations:
+    #   [8][sum z_i*S_i]B == [8](sum z_i*R_i + sum (z_i*h_i)*A_i)
+    # where the z_i are secret 128bit random values, and the terms of a
+    # repeated vk are merged into a single A term. Only if this check
+    # fails, each signature is verified individually (with open()).
+    # A batch is accepted iff each of its signatures would be accepted.
+    # Each distinct key costs about as much as a single verification,
+    # hence a batch is only tried if it has two signatures more than keys.
+    ok = [False] * len(items)
+    vks = set(vk.vk_s if isinstance(vk, VerifyingKey) else vk
+              for vk, _, _ in items)
+    if len(items) < len(vks) + 2:
+        todo, keys = range(len(items)), {}
+    else:
+        todo, keys = _batch(items, ok, entropy)
+    for i in todo: # fallback: find the culprit(s)
+        vk, sig, msg = items[i]
+        A = None
+        if isinstance(vk, VerifyingKey):
+            vk, A = vk.vk_s, vk.A
+        try:
+            open(sig + msg, vk, keys[vk][0] if vk in keys else A)
+            ok[i] = True
+        except BadSignatureError:
+            pass
+    return ok
+
+def _batch(items, ok, entropy): # -> indices still to check, keys
+    todo = []
+    keys = {}  # vk ~ [A, sum z_i*h_i]
+    pts, ns = [], []
+    s_sum = 0
+    Rs = bytes_to_unknown_group_elements([sig[:32] for _, sig, _ in items])
+    for i in range(len(items)):
+        vk, sig, msg = items[i]
+        key = vk
+        if isinstance(vk, VerifyingKey):
+            vk = vk.vk_s
+        assert len(vk) == 32 and len(sig) == 64
+        R = Rs[i]
+        S = bytes_to_scalar(sig[32:])
+        if R is None or S >= L: # open() would also fail
+            continue
+        try:
+            if not vk in keys:
+                A = key.element() if key is not vk else bytes_to_element(vk)
+                keys[vk] = [A, 0]
+        except Exception: # cannot be decoded, open() would also fail
+            continue
+        z = int.from_bytes(entropy(16), 'little')
+        h = Hint(sig[:32] + vk + msg)
+        s_sum += z * S
+        keys[vk][1] += z * h
+        pts.append(R.XYTZ)
+        ns.append(z)
+        todo.append(i)
+    if len(todo) > 1:
+        for A, n in keys.values():
+            pts.append(A.XYTZ)
+            ns.append(n % L)
+        v = Base.scalarmult(s_sum).XYTZ
+        v = add_elements(v, negate_element(multiscalarmult_elements(pts, ns)))
+        if _is_small_order(v):
+            for i in todo:
+                ok[i] = True
+            return [], keys
+    return todo, keys
+
 # ed25519_oop.py ------------------------------------------------------------
 
 # import os
@@ -120,6 +233,7 @@ class SigningKey(object):
                 raise ValueError("SigningKey takes 32-byte seed or 64-byte string")
         self.sk_s = sk_s # seed+pubkey
         self.vk_s = sk_s[32:] # just pubkey
+        self.expanded = expand(sk_s) # (scalar, nonce prefix)
 
     def __eq__(self, them):
         if not isinstance(them, object): return False
@@ -131,7 +245,7 @@ class SigningKey(object):
 
     def sign(self, msg):
         assert isinstance(msg, bytes)
-        sig_and_msg = sign(msg, self.sk_s)
+        sig_and_msg = sign(msg, self.sk_s, self.expanded)
         # the response is R+S+msg
         sig_R = sig_and_msg[0:32]
         sig_S = sig_and_msg[32:64]
@@ -140,17 +254,27 @@ class SigningKey(object):
         assert msg_out == msg
         return sig_out
 
+    def sign_many(self, msgs):
+        return sign_many(msgs, self.sk_s, self.expanded)
+
 class VerifyingKey(object):
     def __init__(self, vk_s):
         assert isinstance(vk_s, bytes)
         assert len(vk_s) == 32
         self.vk_s = vk_s
+        self.A = None # decoded point, see element()
 
     def __eq__(self, them):
         if not isinstance(them, object): return False
         return (them.__class__ == self.__class__
                 and them.vk_s == self.vk_s)
 
+    def element(self):
+        # decodes (and checks) the key only once, can raise ValueError
+        if self.A is None:
+            self.A = bytes_to_element(self.vk_s)
+        return self.A
+
     def verify(self, sig, msg):
         assert isinstance(sig, bytes)
         assert isinstance(msg, bytes)
@@ -158,11 +282,17 @@ class VerifyingKey(object):
         sig_R = sig[:32]
         sig_S = sig[32:]
         sig_and_msg = sig_R + sig_S + msg
+        if self.A is None:
+            try:
+                self.element()
+            except Exception: # open() will report it
+                pass
         # this might raise BadSignatureError
-        msg2 = open(sig_and_msg, self.vk_s)
+        msg2 = open(sig_and_msg, self.vk_s, self.A)
         assert msg2 == msg
 
-__all__ = ['create_keypair', 'SigningKey', 'VerifyingKey', 'BadSignatureError']
+__all__ = ['create_keypair', 'SigningKey', 'VerifyingKey', 'BadSignatureError',
+           'verify_batch', 'precompute_base']
 
 '''
 def selftest():
@@ -176,6 +176,88 @@ def scalarmult_element(pt, n):
             v = _add_elements_nonunfied(v, pt)
     return v
 
+def multiscalarmult_elements(pts, ns): # extended->extended
+    # computes n1*pt1 + n2*pt2 + ... with one chain of doublings that is
+    # shared by all terms (interleaved "Straus" method). Unified additions
+    # are used because intermediate sums can be Zero or equal to a term.
+    v = xform_affine_to_extended((0,1))
+    i = 0
+    for n in ns:
+        assert n >= 0
+        i = max(i, n.bit_length())
+    while i > 0:
+        v = double_element(v)
+        i -= 1
+        for pt, n in zip(pts, ns):
+            if (n >> i) & 1:
+                v = add_elements(v, pt)
+    return v
+
+# joint double-scalar multiplication a*B + b*pt for signature verification:
+# both scalars are recoded in width-w NAF (signed odd digits, at most one
+# non-zero digit in any w consecutive ones) and processed in a single
+# chain of doublings, using tables of odd multiples of B and of pt.
+# Variable-time, hence only to be used with public data.
+
+BASE_WNAF = 7
+PT_WNAF = 5
+
+_base_odd = None
+
+def negate_element(pt): # extended->extended
+    (X, Y, Z, T) = pt
+    return ((-X) % Q, Y, Z, (-T) % Q)
+
+def _wnaf(n, w): # least significant digit first
+    digits = []
+    while n > 0:
+        k = 0
+        if n & 1:
+            k = n & ((1 << w) - 1)
+            if k >= (1 << (w-1)):
+                k -= (1 << w)
+            n -= k
+        digits.append(k)
+        n >>= 1
+    return digits
+
+def _odd_multiples(pt, w): # [1*pt, 3*pt, 5*pt, ..]
+    pt2 = double_element(pt)
+    lst = [pt]
+    for i in range((1 << (w-2)) - 1):
+        lst.append(add_elements(lst[-1], pt2))
+    return lst
+
+def double_scalarmult_base(a, b, pt): # ints,extended->extended
+    global _base_odd
+    if _base_odd == None:
+        _base_odd = _odd_multiples(xform_affine_to_extended(B), BASE_WNAF)
+    na = _wnaf(a, BASE_WNAF)
+    nb = _wnaf(b, PT_WNAF)
+    tb = _odd_multiples(pt, PT_WNAF)
+    v = xform_affine_to_extended((0,1))
+    i = max(len(na), len(nb))
+    while i > 0:
+        v = double_element(v)
+        i -= 1
+        k = na[i] if i < len(na) else 0
+        if k > 0:
+            v = add_elements(v, _base_odd[k >> 1])
+        elif k < 0:
+            v = add_elements(v, negate_element(_base_odd[(-k) >> 1]))
+        k = nb[i] if i < len(nb) else 0
+        if k > 0:
+            v = add_elements(v, tb[k >> 1])
+        elif k < 0:
+            v = add_elements(v, negate_element(tb[(-k) >> 1]))
+    return v
+
+def is_extended_equal(pt1, pt2):
+    # compares two points without converting them to affine coordinates
+    (X1, Y1, Z1, _) = pt1
+    (X2, Y2, Z2, _) = pt2
+    return (X1*Z2 - X2*Z1) % Q == 0 and (Y1*Z2 - Y2*Z1) % Q == 0
+
 # points are encoded as 32-bytes little-endian, b255 is sign, b2b1b0 are 0
 
 def encodepoint(P):
@@ -207,6 +289,45 @@ def decodepoint(s):
     if not isoncurve(P): raise NotOnCurve("decoding point that is not on curve")
     return P
 
+# bulk conversions: Montgomery's trick replaces the N field inversions
+# by a single one (plus 3 multiplications per value)
+
+def batch_inv(xs): # all values must be non-zero mod Q
+    acc = []
+    a = 1
+    for x in xs:
+        acc.append(a)
+        a = (a * x) % Q
+    a = inv(a)
+    res = [0] * len(xs)
+    for i in range(len(xs)-1, -1, -1):
+        res[i] = (a * acc[i]) % Q
+        a = (a * xs[i]) % Q
+    return res
+
+def encode_points(pts): # list of extended -> list of 32B encodings
+    zi = batch_inv([pt[2] for pt in pts])
+    return [encodepoint(((pt[0]*z) % Q, (pt[1]*z) % Q))
+            for pt, z in zip(pts, zi)]
+
+def decode_points(lst): # list of 32B -> list of affine points (or None)
+    # same as decodepoint() for each element, but only one inversion
+    # (the square roots still cost one exponentiation per point)
+    clamp = (1 << 255) - 1
+    ys = [int.from_bytes(s[:32], 'little') for s in lst]
+    dens = [(d*(y & clamp)**2) % Q + 1 for y in ys] # never 0
+    res = []
+    for unclamped, i in zip(ys, batch_inv(dens)):
+        y = unclamped & clamp # clear MSB
+        xx = ((y*y - 1) * i) % Q
+        x = pow3(xx, (Q+3)//8, Q)
+        if (((x*x) % Q) - xx) % Q != 0: x = (x*I) % Q
+        if x % 2 != 0: x = Q-x
+        if bool(x & 1) != bool(unclamped & (1<<255)): x = Q-x
+        P = [x,y]
+        res.append(P if isoncurve(P) else None)
+    return res
+
 # scalars are encoded as 32-bytes little-endian
 
 def bytes_to_scalar(s):
@@ -332,7 +453,92 @@ class _ZeroElement(ElementOfUnknownGroup):
         return self.add(other.negate())
 
 
-Base = Element(xform_affine_to_extended(B))
+# fixed-base scalar multiplication: for each 4bit window i of a scalar we
+# precompute the points j*16^i*B (j=1..15), so that multiplying the base
+# point needs at most 64 additions and no doublings at all. The table
+# (960 points) is built lazily on first use, or loaded from a file.
+
+BASE_WINDOW = 4
+BASE_ROWS = 64  # 64*4bit covers scalars < L < 2^253
+
+_base_table = None
+
+def _mk_base_table():
+    tbl = []
+    pt = xform_affine_to_extended(B)
+    for i in range(BASE_ROWS):
+        row = [pt]
+        for j in range(2, 1 << BASE_WINDOW):
+            row.append(add_elements(row[-1], pt))
+        tbl.append(row)
+        pt = add_elements(row[-1], pt) # 16^(i+1)*B
+    return tbl
+
+def precompute_base(fn=None):
+    # builds the fixed-base table, or loads it from file fn. If fn does
+    # not exist (or is broken), the built table is persisted there.
+    # File format: affine (x,y) of all points, 2x32B little-endian each,
+    # followed by the SHA256 of these bytes. A loaded table is only used
+    # if the hash matches and all points are on the curve.
+    global _base_table
+    cnt = BASE_ROWS * ((1 << BASE_WINDOW) - 1)
+    if fn != None:
+        try:
+            with open(fn, 'rb') as f:
+                buf = f.read()
+            assert len(buf) == 64 * cnt + 32
+            assert hashlib.sha256(buf[:-32]).digest() == buf[-32:]
+            assert int.from_bytes(buf[:32], 'little') == Bx
+            assert int.from_bytes(buf[32:64], 'little') == By
+            tbl, row = [], []
+            for i in range(0, len(buf) - 32, 64):
+                x = int.from_bytes(buf[i:i+32], 'little')
+                y = int.from_bytes(buf[i+32:i+64], 'little')
+                assert isoncurve((x,y))
+                row.append(xform_affine_to_extended((x,y)))
+                if len(row) == (1 << BASE_WINDOW) - 1:
+                    tbl.append(row)
+                    row = []
+            _base_table = tbl
+            return
+        except Exception: # missing, truncated or corrupted: rebuild
+            pass
+    if _base_table == None:
+        _base_table = _mk_base_table()
+    if fn != None:
+        buf = bytearray()
+        for row in _base_table:
+            for pt in row:
+                (x, y) = xform_extended_to_affine(pt)
+                buf += x.to_bytes(32, 'little') + y.to_bytes(32, 'little')
+        with open(fn, 'wb') as f:
+            f.write(buf + hashlib.sha256(buf).digest())
+
+def scalarmult_base(n): # int->extended, for 0 <= n < 2^256
+    if _base_table == None:
+        precompute_base()
+    v = xform_affine_to_extended((0,1))
+    i = 0
+    while n > 0:
+        j = n & ((1 << BASE_WINDOW) - 1)
+        if j:
+            v = add_elements(v, _base_table[i][j-1])
+        n >>= BASE_WINDOW
+        i += 1
+    return v
+
+class _BaseElement(Element):
+    # the generator, which gets the table-driven scalarmult
+
+    def scalarmult(self, s):
+        if isinstance(s, ElementOfUnknownGroup):
+            raise TypeError("elements cannot be multiplied together")
+        s = s % L
+        if s == 0:
+            return Zero
+        return Element(scalarmult_base(s))
+
+Base = _BaseElement(xform_affine_to_extended(B))
 Zero = _ZeroElement(xform_affine_to_extended((0,1))) # the neutral (identity) element
 
 _zero_bytes = Zero.to_bytes()
@@ -422,3 +628,17 @@ def bytes_to_element(bytes):
     # the point is in the expected 1*L subgroup, not in the 2/4/8 groups,
     # or in the 2*L/4*L/8*L groups. Promote it to a correct-group Element.
     return Element(P.XYTZ)
+
+def bytes_to_unknown_group_elements(lst):
+    # bulk version of bytes_to_unknown_group_element(), with None for
+    # encodings that are not on the curve. No subgroup check: this is
+    # for callers that multiply by the cofactor (see verify_batch())
+    res = []
+    for s, P in zip(lst, decode_points(lst)):
+        if P == None:
+            res.append(None)
+        elif s == _zero_bytes:
+            res.append(Zero)
+        else:
+            res.append(ElementOfUnknownGroup(xform_affine_to_extended(P)))
+    return res
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# test_crypto.py  -- pure25519 arithmetic and (batch) verification
+
+import random
+
+import pure25519
+from pure25519 import basic
+from tinyssb import crypto
+
+rnd = random.Random(25519)
+
+def mkkeys(n):
+    return [pure25519.SigningKey(rnd.getrandbits(256).to_bytes(32, 'big'))
+            for i in range(n)]
+
+def test_scalarmult():
+    B = basic.Base.XYTZ
+    P = basic.Base.scalarmult(rnd.randrange(1, basic.L)).XYTZ
+    for n in [0, 1, 2, 7, basic.L - 1, basic.L, 2**256 - 1] + \
+             [rnd.getrandbits(256) for i in range(4)]:
+        ref = basic.scalarmult_element_safe_slow(B, n)
+        assert basic.is_extended_equal(basic.scalarmult_base(n), ref)
+    for i in range(4):
+        a, b = rnd.getrandbits(253), rnd.getrandbits(253)
+        ref = basic.add_elements(basic.scalarmult_element_safe_slow(B, a),
+                                 basic.scalarmult_element_safe_slow(P, b))
+        v = basic.double_scalarmult_base(a, b, P)
+        assert basic.is_extended_equal(v, ref)
+        v = basic.multiscalarmult_elements([B, P], [a, b])
+        assert basic.is_extended_equal(v, ref)
+
+def test_batch_inv():
+    xs = [1, 2, basic.Q - 1] + [rnd.randrange(1, basic.Q) for i in range(9)]
+    assert basic.batch_inv(xs) == [basic.inv(x) for x in xs]
+    assert basic.batch_inv([]) == []
+
+def test_open_rejects_large_S():
+    sk = mkkeys(1)[0]
+    vk = sk.get_verifying_key()
+    sig = sk.sign(b'msg')
+    vk.verify(sig, b'msg')
+    S = int.from_bytes(sig[32:], 'little')
+    for s in [S + basic.L, S + 2 * basic.L]:
+        if s >= 2**256: continue
+        try:
+            vk.verify(sig[:32] + s.to_bytes(32, 'little'), b'msg')
+            assert False, "S >= L was accepted"
+        except pure25519.BadSignatureError:
+            pass
+
+def test_verify_batch():
+    sks = mkkeys(3)
+    vks = [sk.get_verifying_key() for sk in sks]
+    items, expect = [], []
+    for i in range(12):
+        j = i % 3
+        msg = b'entry %d' % i
+        sig = sks[j].sign(msg)
+        if i in [2, 7]: # corrupted S
+            sig = sig[:40] + bytes([sig[40] ^ 0x10]) + sig[41:]
+        if i == 5: # signed by another key
+            sig = sks[(j+1) % 3].sign(msg)
+        if i == 9: # S+L
+            S = int.from_bytes(sig[32:], 'little') + basic.L
+            sig = sig[:32] + S.to_bytes(32, 'little')
+        items.append((vks[j] if i % 2 else vks[j].vk_s, sig, msg))
+        expect.append(i not in [2, 5, 7, 9])
+    pk, msg, sig = [bytes.fromhex(x) for x in crypto.TORSION_VECTOR]
+    items.append((pk, sig, msg))
+    expect.append(True)
+    items.append((pk, sig, msg + b'x'))
+    expect.append(False)
+    assert pure25519.verify_batch(items) == expect
+    assert pure25519.verify_batch([x for x, e in zip(items, expect)
+                                   if e]) == [True] * expect.count(True)
+    for (vk, sig, msg), e in zip(items, expect): # same result one by one
+        if not isinstance(vk, bytes): vk = vk.vk_s
+        try:
+            pure25519.VerifyingKey(vk).verify(sig, msg)
+            assert e
+        except pure25519.BadSignatureError:
+            assert not e
+
+def test_backends():
+    names = [be.name for be in crypto.available()]
+    assert 'pure25519' in names
+
+# ----------------------------------------------------------------------
+
+if __name__ == '__main__':
+    test_scalarmult()
+    test_batch_inv()
+    test_open_rejects_large_S()
+    test_verify_batch()
+    test_backends()
+    print("ok")
+
+# eof
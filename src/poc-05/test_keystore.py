@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+# test_keystore.py  -- key pool of the keystore
+
+import time
+
+from tinyssb import keystore
+
+def wait_for(cond, secs=10):
+    t = time.time() + secs
+    while not cond():
+        assert time.time() < t, "timeout"
+        time.sleep(0.01)
+
+def test_pool_restart():
+    ks = keystore.Keystore()
+    for i in range(3): # stop_pool() must not leave start_pool() blocked
+        ks.start_pool(2)
+        wait_for(lambda: len(ks.pool) == 2)
+        pk = ks.new('k%d' % i)
+        assert ks.verify(pk, ks.sign(pk, b'msg'), b'msg')
+        wait_for(lambda: len(ks.pool) == 2) # refilled after new()
+        ks.stop_pool()
+    ks.start_pool(3) # restart right after a stop, without waiting
+    wait_for(lambda: len(ks.pool) == 3)
+    time.sleep(0.2)
+    assert len(ks.pool) == 3 # only one worker is filling the pool
+    ks.stop_pool()
+
+def test_pool_depth_raised():
+    ks = keystore.Keystore()
+    ks.start_pool(1)
+    wait_for(lambda: len(ks.pool) == 1)
+    time.sleep(0.1) # worker is now waiting for a wakeup
+    ks.start_pool(3)
+    wait_for(lambda: len(ks.pool) == 3)
+    ks.stop_pool()
+
+# ----------------------------------------------------------------------
+
+if __name__ == '__main__':
+    test_pool_restart()
+    test_pool_depth_raised()
+    print("ok")
+
+# eof
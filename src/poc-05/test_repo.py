@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+# test_repo.py  -- disk storage of logs and sidechains
+
+import io
+import os
+import shutil
+import tempfile
+import _thread
+
+from tinyssb import keystore, packet, repository
+
+def mkrepo(**kw):
+    path = tempfile.mkdtemp()
+    repo = repository.REPO(path, keystore.verify_signature,
+                           keystore.mkverifybatchfct(), **kw)
+    return path, repo
+
+def mkfeed(repo, ks, n):
+    # new log with n entries after the genesis block
+    pk = ks.new()
+    sign = ks.get_signFct(pk)
+    feed = repo.mk_generic_log(pk, packet.PKTTYPE_plain48, bytes(48), sign)
+    for i in range(n):
+        feed.write_plain_48B(bytes([i]) * 48, sign)
+    return feed, sign
+
+def mids(feed): # seq ~ msgID, by following the chain from the anchor
+    lst = {feed.anchrS: feed.anchrM}
+    for i in range(feed.anchrS + 1, feed.frontS + 1):
+        lst[i] = feed.ctx.mid(i, lst[i-1], bytes(feed[i].wire))
+    return lst
+
+def set_front(fn, seq, mid): # overwrite the header's front fields
+    with open(fn, 'rb+') as f:
+        f.seek(12+92)
+        f.write(seq.to_bytes(4, 'big') + mid)
+
+def test_recovery():
+    ks = keystore.Keystore()
+    for crash in ['torn', 'lagging', 'short', 'bad']:
+        path, repo = mkrepo()
+        feed, sign = mkfeed(repo, ks, 20)
+        fid, fn, m = feed.fid, feed.fn, mids(feed)
+        repo.commit()
+        if crash == 'torn': # half written last record
+            with open(fn, 'ab') as f: f.write(b'x' * 50)
+            front = 21
+        elif crash == 'lagging': # group commit: header not yet updated
+            set_front(fn, 10, m[10])
+            front = 21
+        elif crash == 'short': # header ahead of the entries
+            with open(fn, 'rb+') as f: f.truncate(128 + 128*15 + 77)
+            front = 15
+        else: # entry after a lagging header was corrupted
+            set_front(fn, 10, m[10])
+            with open(fn, 'rb+') as f:
+                f.seek(128*14 + 100)
+                f.write(b'X')
+            front = 13
+        repo2 = repository.REPO(path, keystore.verify_signature,
+                                keystore.mkverifybatchfct())
+        feed = repo2.get_log(fid)
+        assert feed.getfront() == (front, m[front]), crash
+        assert feed.write_plain_48B(b'z' * 48, sign) != None
+        assert len(feed) == front + 1
+        shutil.rmtree(path)
+
+def test_blob_gc():
+    ks = keystore.Keystore()
+    path, repo = mkrepo()
+    a, sign_a = mkfeed(repo, ks, 0)
+    b, sign_b = mkfeed(repo, ks, 0)
+    shared = os.urandom(3000) # same blobs in a chain of each log
+    data_b = os.urandom(2000)
+    pa = repo.write_chain(a.fid, io.BytesIO(shared), sign_a)
+    pb = repo.write_chain(b.fid, io.BytesIO(shared), sign_b)
+    pc = repo.write_chain(b.fid, io.BytesIO(data_b), sign_b)
+    for i in range(7): # not referenced by any log
+        repo.add_blob(os.urandom(120))
+    n = len(repo.blobs)
+    report = repository.BLOBGC(repo).run()
+    assert report['garbage'] == 7 and len(repo.blobs) == n - 7
+    repo.blobs.compact()
+    assert repo.read_chain(pa) == shared and repo.read_chain(pc) == data_b
+    repo.enable_blob_refs()
+    repo.del_log(a.fid) # the shared blobs are still used by b
+    repo.blobs.compact()
+    assert repository.BLOBGC(repo).run()['garbage'] == 0
+    repo2 = repository.REPO(path, keystore.verify_signature)
+    repo2.chain_cache.maxbytes = 0 # read from the blob store
+    assert repo2.read_chain(pb) == shared and repo2.read_chain(pc) == data_b
+    shutil.rmtree(path)
+
+def test_blob_gc_quarantine():
+    ks = keystore.Keystore()
+    path, repo = mkrepo()
+    feed, sign = mkfeed(repo, ks, 0)
+    data = os.urandom(2000)
+    repo.write_chain(feed.fid, io.BytesIO(data), sign)
+    path2, repo2 = mkrepo()
+    copy = repo2.allocate_log(feed.fid, 0, feed.fid[:20])
+    for h in repo.blobs:
+        repo2.add_blob(repo.get_blob(h))
+    for i in range(1, 3):
+        assert repo2.ingest(feed.fid, bytes(feed[i].wire)) != None
+    assert len(copy.quar) == 2 # chain20 entry not yet verified
+    assert repository.BLOBGC(repo2).run()['garbage'] == 0
+    repo2.verify_quarantine()
+    assert repo2.read_chain(copy[2]) == data
+    shutil.rmtree(path)
+    shutil.rmtree(path2)
+
+def test_blob_compaction_readers():
+    path, repo = mkrepo()
+    blobs = {}
+    for i in range(1000):
+        buf = os.urandom(120)
+        blobs[repo.add_blob(buf)] = buf
+    hptrs = list(blobs)
+    state = {'stop': False, 'bad': 0, 'running': 0}
+    def reader():
+        state['running'] += 1
+        while not state['stop']:
+            for h in hptrs[::7]:
+                buf = repo.blobs.be.get(h)
+                if buf != None and buf != blobs[h]:
+                    state['bad'] += 1
+        state['running'] -= 1
+    for i in range(2):
+        _thread.start_new_thread(reader, tuple())
+    for h in hptrs[:600]:
+        repo.blobs.remove(h)
+    repo.blobs.compact() # moves the remaining blobs
+    state['stop'] = True
+    while state['running'] > 0:
+        pass
+    assert state['bad'] == 0
+    assert all(repo.get_blob(h) == blobs[h] for h in hptrs[600:])
+    shutil.rmtree(path)
+
+def test_truncate_with_quarantine():
+    ks = keystore.Keystore()
+    path, repo = mkrepo()
+    feed, sign = mkfeed(repo, ks, 0)
+    data = [os.urandom(1000) for i in range(3)]
+    for d in data:
+        repo.write_chain(feed.fid, io.BytesIO(d), sign)
+    path2, repo2 = mkrepo()
+    repo2.enable_blob_refs()
+    for h in list(repo.blobs):
+        repo2.add_blob(repo.get_blob(h))
+    copy = repo2.allocate_log(feed.fid, 0, feed.fid[:20])
+    for i in range(1, 5):
+        repo2.ingest(feed.fid, bytes(feed[i].wire))
+    n = len(repo2.blobs)
+    # deferred while entries are quarantined: nothing is dropped
+    assert repo2.truncate_log(feed.fid, 3) == 0 and len(repo2.blobs) == n
+    repo2.verify_quarantine()
+    assert [repo2.read_chain(copy[i]) for i in range(2, 5)] == data
+    # only the blobs of the dropped entries are freed
+    assert repo2.truncate_log(feed.fid, 3) == 2
+    assert len(repo2.blobs) == 2 * n // 3
+    assert [repo2.read_chain(copy[i]) for i in range(3, 5)] == data[1:]
+    shutil.rmtree(path)
+    shutil.rmtree(path2)
+
+def test_message_index():
+    ks = keystore.Keystore()
+    path, repo = mkrepo()
+    repo.enable_index()
+    feed, sign = mkfeed(repo, ks, 20)
+    m = mids(feed)
+    for i in range(1, 22):
+        assert repo.find_mid(m[i]) == (feed.fid, i)
+        assert repo.find_dmx(feed[i].dmx) == (feed.fid, i)
+        assert repo.find_proof(feed[i].wire[-12:]) == (feed.fid, i)
+    repo.commit()
+    with open(feed.fn, 'rb+') as f: # crash: the log loses its last entries
+        f.truncate(128 + 128*15)
+    repo2 = repository.REPO(path, keystore.verify_signature)
+    repo2.enable_index()
+    feed = repo2.get_log(feed.fid)
+    assert len(feed) == 15 and repo2.find_mid(m[18]) == None
+    feed.write_plain_48B(b'z' * 48, sign) # a different entry 16
+    m16 = feed.ctx.mid(16, m[15], bytes(feed[16].wire))
+    repo3 = repository.REPO(path, keystore.verify_signature)
+    repo3.enable_index()
+    assert repo3.find_mid(m16) == (feed.fid, 16)
+    assert repo3.find_mid(m[16]) == None and len(repo3.index.mid) == 16
+    shutil.rmtree(path)
+
+def test_append_during_ingest():
+    ks = keystore.Keystore()
+    path, repo = mkrepo()
+    feed, _ = mkfeed(repo, ks, 5)
+    wires = [bytes(feed[i].wire) for i in range(1, 7)]
+    path2, repo2 = mkrepo()
+    copy = repo2.allocate_log(feed.fid, 0, feed.fid[:20])
+    for w in wires[:3]:
+        assert repo2.ingest(feed.fid, w) != None
+    # a live append must not overtake the quarantine, nor raise
+    assert copy.append(wires[0]) == None
+    assert copy.append_many(wires[:2]) == []
+    repo2.verify_quarantine()
+    assert len(copy) == 3
+    assert copy.append(wires[3]) != None and len(copy) == 4
+    shutil.rmtree(path)
+    shutil.rmtree(path2)
+
+def test_concurrent_promote():
+    ks = keystore.Keystore()
+    path, repo = mkrepo()
+    feed, _ = mkfeed(repo, ks, 40)
+    wires = [bytes(feed[i].wire) for i in range(1, 42)]
+    path2, repo2 = mkrepo()
+    copy = repo2.allocate_log(feed.fid, 0, feed.fid[:20])
+    for w in wires:
+        assert repo2.ingest(feed.fid, w) != None
+    done = _thread.allocate_lock()
+    done.acquire()
+    def other():
+        while len(copy.quar) > 0:
+            copy.promote(3)
+        done.release()
+    _thread.start_new_thread(other, tuple())
+    repo2.verify_quarantine(5)
+    done.acquire()
+    assert copy.quar == [] and copy.frontS == 41
+    assert mids(copy) == mids(feed)
+    shutil.rmtree(path)
+    shutil.rmtree(path2)
+
+def test_write_chain_spool():
+    ks = keystore.Keystore()
+    path, repo = mkrepo()
+    feed, sign = mkfeed(repo, ks, 0)
+    def chunks(data, fail=False):
+        for i in range(0, len(data), 100):
+            yield data[i:i+100]
+            if fail: raise IOError("source failed")
+    try:
+        repo.write_chain(feed.fid, chunks(bytes(500), True), sign)
+        assert False
+    except IOError:
+        pass
+    assert [fn for fn in os.listdir(path) if fn.startswith('_spool')] == []
+    datas = [os.urandom(700 + i) for i in range(4)]
+    pkts, lock, done = [], _thread.allocate_lock(), _thread.allocate_lock()
+    def write(data):
+        pkt = repo.write_chain(feed.fid, chunks(data), sign)
+        with lock:
+            pkts.append(pkt)
+            if len(pkts) == len(datas): done.release()
+    done.acquire()
+    for d in datas: # all spooled at the same time, to one feed
+        _thread.start_new_thread(write, (d,))
+    done.acquire()
+    got = sorted(repo.read_chain(p) for p in pkts)
+    assert got == sorted(datas)
+    assert [fn for fn in os.listdir(path) if fn.startswith('_spool')] == []
+    shutil.rmtree(path)
+
+def test_readers_and_handles():
+    ks = keystore.Keystore()
+    path, repo = mkrepo(max_open=2)
+    feeds = [mkfeed(repo, ks, 10) for i in range(5)]
+    mm = repository.mmap
+    for m in [mm, None]: # mapped reads, and the pread fallback
+        repository.mmap = m
+        try:
+            feed, sign = feeds[0]
+            feed.close()
+            done = _thread.allocate_lock()
+            done.acquire()
+            def read():
+                feed[5]
+                feed.read_range(1, 11)
+                done.release()
+            with feed.wlock: # readers must not wait for a writer
+                _thread.start_new_thread(read, tuple())
+                assert done.acquire(1, 5), "reader blocked by the writer"
+            errs, mutex = [], _thread.allocate_lock()
+            left = _thread.allocate_lock()
+            left.acquire()
+            cnt = [len(feeds)]
+            def reader(feed):
+                try:
+                    for i in range(200):
+                        assert feed.read_range(1, 11) == \
+                               [bytes(feed[s].wire) for s in range(1, 11)]
+                except Exception as e:
+                    errs.append(e)
+                with mutex:
+                    cnt[0] -= 1
+                    if cnt[0] == 0: left.release()
+            for feed, sign in feeds: # evicting each other's handles
+                _thread.start_new_thread(reader, (feed,))
+            assert left.acquire(1, 60) and errs == []
+            for feed, sign in feeds:
+                assert feed.users == {}
+            assert len([f for f, s in feeds if f._f != None]) <= 2
+        finally:
+            repository.mmap = mm
+    shutil.rmtree(path)
+
+# ----------------------------------------------------------------------
+
+if __name__ == '__main__':
+    test_recovery()
+    test_blob_gc()
+    test_blob_gc_quarantine()
+    test_blob_compaction_readers()
+    test_truncate_with_quarantine()
+    test_message_index()
+    test_append_during_ingest()
+    test_concurrent_promote()
+    test_write_chain_spool()
+    test_readers_and_handles()
+    print("ok")
+
+# eof
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+# tinyssb/blobstore.py  -- storage backends for 120B blobs (sidechains)
+
+'''
+Both backends are keyed by the blob's hashptr (first 20B of its SHA256)
+and have the same methods:
+
+  add(hptr, buf120)   stores the blob, no-op if already present
+  get(hptr)           -> buf120, or None
+  remove(hptr)
+  compact()           reclaims the space of removed blobs
+  __contains__(hptr)
+  __iter__()          -> all hptrs
+  __len__()
+
+BLOBDIR   the original layout, one file per blob:
+
+  _blob/05/REST_OF_HASHPTR1_IN_HEX
+
+BLOBPACK  blobs appended to segment files, with an index file:
+
+  _blob/pack-0000     120B records, at most seg_size bytes per file
+  _blob/pack-0001
+  _blob/pack.idx      24B records: hashptr (20B) + position (4B, big endian)
+
+  The position counts the records over all segments. The index has one
+  record per blob, in the same order as the segments, so after a crash
+  it can be cut to the stored blobs, or completed by hashing the
+  segments' tail. It is loaded into a dict at startup. remove() appends
+  a record with position 0xffffffff, compact() rewrites the segments
+  as pack-NNNN.new and commits them by renaming pack.idx.new to
+  pack.idx.done (an interrupted swap is finished at startup).
+
+BLOBCACHE wraps a backend with a byte-bounded LRU of recently added or
+served blobs and, for BLOBDIR, with an in-memory existence filter (an
+exact set while the store is small, a Bloom filter beyond that), so that
+probing for missing blobs and serving hot ones do not touch the disk.
+'''
+
+from collections import OrderedDict
+import hashlib
+import os
+import sys
+import _thread
+
+from tinyssb import util
+
+if sys.implementation.name == 'micropython':
+    pread = None
+else:
+    pread = getattr(os, 'pread', None) # not on Windows
+
+def _size(fn):
+    try:    return os.stat(fn)[6]
+    except: return -1
+
+def _fsync_close(f):
+    f.flush()
+    try:    os.fsync(f.fileno())
+    except: pass
+    f.close()
+
+def _fsync_dir(path): # makes new directory entries (files) durable
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:    os.fsync(fd)
+        finally: os.close(fd)
+    except: pass # not on micropython, nor on Windows
+
+# ----------------------------------------------------------------------
+
+class BLOBDIR:
+
+    exact = False # membership needs a stat()
+
+    def __init__(self, path):
+        self.path = path
+        self.dirs = set() # XX subdirectories known to exist
+
+    def _fn(self, hptr):
+        h = util.hex(hptr)
+        return self.path + '/' + h[:2] + '/' + h[2:]
+
+    def add(self, hptr, buf120):
+        fn = self._fn(hptr)
+        dn = fn[:-39]
+        if not dn in self.dirs:
+            if _size(dn) < 0:   os.mkdir(dn)
+            self.dirs.add(dn)
+        if _size(fn) >= 0:  return
+        with open(fn, "wb+") as f:  f.write(buf120)
+
+    def get(self, hptr):
+        try:
+            with open(self._fn(hptr), "rb") as f: return f.read(120)
+        except Exception as e:
+            # print("get_blob", e)
+            pass
+        return None
+
+    def __contains__(self, hptr):
+        return _size(self._fn(hptr)) >= 0
+
+    def remove(self, hptr):
+        try:    os.remove(self._fn(hptr))
+        except: pass
+
+    def compact(self, force=True):
+        return len(self)
+
+    def __iter__(self):
+        for dn in os.listdir(self.path):
+            if len(dn) != 2: continue # not a blob directory
+            for fn in os.listdir(self.path + '/' + dn):
+                yield util.fromhex(dn + fn)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+# ----------------------------------------------------------------------
+
+class BLOBPACK:
+
+    exact = True  # membership is answered by the in-memory index
+    TOMB = 0xffffffff # index record position for a removed blob
+
+    def __init__(self, path, seg_size=64*1024*1024):
+        self.path = path
+        self.seg_recs = seg_size // 120
+        self.lock = _thread.allocate_lock()
+        self._load()
+
+    def _seg_fn(self, n):
+        return self.path + '/pack-%04d' % n
+
+    def _load(self):
+        if _size(self.path + '/pack.idx.done') >= 0: # compaction was done
+            self._swap()
+        n = 0
+        while _size(self._seg_fn(n) + '.new') >= 0: # ... or interrupted
+            os.remove(self._seg_fn(n) + '.new')
+            n += 1
+        if _size(self.path + '/pack.idx.new') >= 0:
+            os.remove(self.path + '/pack.idx.new')
+        # the blobs present in the segments decide, the index follows
+        stored, n = 0, 0
+        while True:
+            sz = _size(self._seg_fn(n))
+            if sz < 0: break
+            if sz % 120 != 0: # torn last record
+                with open(self._seg_fn(n), 'rb+') as f: f.truncate(sz - sz%120)
+            stored += sz // 120
+            n += 1
+        xfn = self.path + '/pack.idx'
+        buf = b''
+        if _size(xfn) > 0:
+            with open(xfn, 'rb') as f: buf = f.read()
+        idx = {}        # hptr ~ position
+        covered = 0     # positions up to here have an index record
+        lost = False
+        for i in range(0, len(buf) - 23, 24):
+            h, pos = buf[i:i+20], int.from_bytes(buf[i+20:i+24], 'big')
+            if pos == self.TOMB:
+                idx.pop(h, None)
+            elif pos >= stored: # index went further than the segments
+                lost = True
+            else:
+                idx[h] = pos
+                covered = max(covered, pos+1)
+        self.idx = idx
+        self.segs = []  # read handles, one per segment
+        # get() works on (idx, segs) pairs, never on a new index with
+        # the old segments (or vice versa): see the end of _load()
+        self.cnt = stored # next position
+        self.dead = stored - len(idx)
+        if lost or len(buf) % 24 != 0:
+            with open(xfn, 'wb') as f:
+                for h, pos in idx.items():
+                    f.write(h + pos.to_bytes(4, 'big'))
+        if covered < stored: # segments went further than the index
+            print("blobstore: indexing", stored - covered, "blobs")
+            with open(xfn, 'ab') as xf:
+                for pos in range(covered, stored):
+                    blob = self._read(self.segs, pos)
+                    hptr = hashlib.sha256(blob).digest()[:20]
+                    self.idx[hptr] = pos
+                    xf.write(hptr + pos.to_bytes(4, 'big'))
+            self.dead = stored - len(self.idx)
+        self.wf = open(self._seg_fn(self.cnt // self.seg_recs), 'ab')
+        self.xf = open(xfn, 'ab')
+        self.view = (self.idx, self.segs) # atomically replaced
+
+    def _read(self, segs, pos):
+        n, off = pos // self.seg_recs, 120 * (pos % self.seg_recs)
+        if n >= len(segs):
+            with self.lock:
+                while len(segs) <= n:
+                    segs.append(open(self._seg_fn(len(segs)), 'rb'))
+        f = segs[n]
+        if pread:
+            return pread(f.fileno(), 120, off)
+        with self.lock:
+            f.seek(off)
+            return f.read(120)
+
+    def add(self, hptr, buf120):
+        with self.lock:
+            if hptr in self.idx: return
+            if self.cnt > 0 and self.cnt % self.seg_recs == 0:
+                _fsync_close(self.wf) # start a new segment
+                self.wf = open(self._seg_fn(self.cnt // self.seg_recs), 'ab')
+            # blob first, then its index record (see _load)
+            self.wf.write(buf120)
+            self.wf.flush()
+            self.xf.write(hptr + self.cnt.to_bytes(4, 'big'))
+            self.xf.flush()
+            self.idx[hptr] = self.cnt
+            self.cnt += 1
+
+    def get(self, hptr):
+        while True: # retry if compact() replaced the files meanwhile
+            view = self.view
+            pos = view[0].get(hptr, None)
+            buf = None if pos == None else self._read(view[1], pos)
+            if view is self.view:
+                return buf
+
+    def remove(self, hptr):
+        # the space is only reclaimed by compact()
+        with self.lock:
+            if self.idx.pop(hptr, None) == None: return
+            self.xf.write(hptr + self.TOMB.to_bytes(4, 'big'))
+            self.xf.flush()
+            self.dead += 1
+
+    def compact(self, force=True):
+        # rewrites the segments with the live blobs only: the new files
+        # are written next to the old ones, the finished index is renamed
+        # to pack.idx.done which commits the swap (see _load). Unless
+        # forced, only done if a quarter of the stored blobs are removed.
+        if not force and 4 * self.dead < self.cnt:
+            return len(self.idx)
+        with self.lock:
+            live = sorted(self.idx.items(), key=lambda x: x[1])
+            segs = self.segs
+            while len(segs) < (self.cnt + self.seg_recs - 1) // self.seg_recs:
+                segs.append(open(self._seg_fn(len(segs)), 'rb'))
+            xf = open(self.path + '/pack.idx.new', 'wb')
+            wf = None
+            for pos in range(len(live)):
+                h, old = live[pos]
+                if pos % self.seg_recs == 0:
+                    if wf: wf.close()
+                    wf = open(self._seg_fn(pos // self.seg_recs) + '.new', 'wb')
+                f = segs[old // self.seg_recs]
+                f.seek(120 * (old % self.seg_recs))
+                wf.write(f.read(120))
+                xf.write(h + pos.to_bytes(4, 'big'))
+            if wf: _fsync_close(wf)
+            _fsync_close(xf)
+            os.rename(self.path + '/pack.idx.new', self.path + '/pack.idx.done')
+            self.wf.close()
+            self.xf.close()
+            self._swap()
+            self._load()
+        return len(live)
+
+    def _swap(self):
+        # replaces the old segments and index with the compacted ones,
+        # can be repeated if interrupted
+        with open(self.path + '/pack.idx.done', 'rb') as f:
+            f.seek(0, 2)
+            cnt = f.tell() // 24 # live blobs, at positions 0..cnt-1
+        nseg = (cnt + self.seg_recs - 1) // self.seg_recs
+        for n in range(nseg):
+            if _size(self._seg_fn(n) + '.new') >= 0:
+                os.rename(self._seg_fn(n) + '.new', self._seg_fn(n))
+        n = nseg
+        while _size(self._seg_fn(n)) >= 0:
+            os.remove(self._seg_fn(n))
+            n += 1
+        os.rename(self.path + '/pack.idx.done', self.path + '/pack.idx')
+
+    def __contains__(self, hptr):
+        return hptr in self.idx
+
+    def __iter__(self):
+        return iter(list(self.idx.keys()))
+
+    def __len__(self):
+        return len(self.idx)
+
+    def migrate(self, other):
+        # moves all blobs of another backend (e.g. a BLOBDIR) into the pack
+        cnt = 0
+        for hptr in other:
+            self.add(hptr, other.get(hptr))
+            cnt += 1
+        if cnt > 0 and isinstance(other, BLOBDIR):
+            # the copies must be durable before the originals are gone
+            # (full segments were synced when the next one was started)
+            with self.lock:
+                for f in [self.wf, self.xf]:
+                    f.flush()
+                    try:    os.fsync(f.fileno())
+                    except: pass # see _fsync_close()
+            _fsync_dir(self.path)
+            for dn in os.listdir(other.path):
+                if len(dn) != 2: continue
+                for fn in os.listdir(other.path + '/' + dn):
+                    os.remove(other.path + '/' + dn + '/' + fn)
+                os.rmdir(other.path + '/' + dn)
+        return cnt
+
+# ----------------------------------------------------------------------
+
+class BLOOM:
+    # the hashptrs are already uniformly distributed: the k probe
+    # positions are taken from k 4B slices of the hashptr
+
+    def __init__(self, nbits=8*1024*1024, k=4):
+        self.nbits = nbits
+        self.k = min(k, 5)
+        self.bits = bytearray((nbits + 7) // 8)
+
+    def _probes(self, hptr):
+        for i in range(0, 4*self.k, 4):
+            yield int.from_bytes(hptr[i:i+4], 'big') % self.nbits
+
+    def add(self, hptr):
+        for i in self._probes(hptr):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, hptr): # false positives are possible
+        for i in self._probes(hptr):
+            if not self.bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+
+class BLOBCACHE:
+
+    def __init__(self, backend, max_bytes=1024*1024,
+                 exact_limit=20000, bloom_bits=8*1024*1024):
+        self.be = backend
+        self.max_bytes = max_bytes
+        self.lru = OrderedDict() # hptr ~ buf120
+        self.lock = _thread.allocate_lock()
+        self.bloom_bits = bloom_bits
+        self.exact_limit = exact_limit
+        self.known = None  # set of all hptrs, or None if too many
+        self.bloom = None  # used once the set would grow too large
+        if not backend.exact:
+            self.known = set()
+            for hptr in backend:
+                self._note(hptr)
+
+    def _note(self, hptr): # remember that the store has this blob
+        if self.known != None:
+            self.known.add(hptr)
+            if len(self.known) <= self.exact_limit:
+                return
+            self.bloom = BLOOM(self.bloom_bits)
+            for h in self.known:
+                self.bloom.add(h)
+            self.known = None
+        else:
+            self.bloom.add(hptr)
+
+    def _cache(self, hptr, buf120):
+        with self.lock:
+            self.lru.pop(hptr, None)
+            self.lru[hptr] = buf120
+            while 120 * len(self.lru) > self.max_bytes and len(self.lru) > 0:
+                self.lru.popitem(last=False) # least recently used
+
+    def __contains__(self, hptr):
+        if hptr in self.lru:
+            return True
+        if self.known != None:
+            return hptr in self.known
+        if self.bloom != None and not hptr in self.bloom:
+            return False
+        return hptr in self.be
+
+    def add(self, hptr, buf120):
+        if self.be.exact or self.known != None:
+            if hptr in self: return
+        self.be.add(hptr, buf120)
+        if not self.be.exact:
+            self._note(hptr)
+        self._cache(hptr, buf120)
+
+    def get(self, hptr):
+        with self.lock:
+            buf = self.lru.pop(hptr, None)
+            if buf != None:
+                self.lru[hptr] = buf # most recently used
+                return buf
+        if self.known != None and not hptr in self.known:
+            return None
+        if self.bloom != None and not hptr in self.bloom:
+            return None
+        buf = self.be.get(hptr)
+        if buf != None:
+            self._cache(hptr, buf)
+        return buf
+
+    def remove(self, hptr):
+        with self.lock:
+            self.lru.pop(hptr, None)
+        if self.known != None:
+            self.known.discard(hptr)
+        # (a Bloom filter cannot forget, this only costs a disk lookup)
+        self.be.remove(hptr)
+
+    def compact(self, force=True):
+        return self.be.compact(force)
+
+    def __iter__(self):
+        return iter(self.be)
+
+    def __len__(self):
+        if self.known != None:
+            return len(self.known)
+        return len(self.be)
+
+# eof
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# tinyssb/crypto.py  -- registry of ed25519 backends
+
+# The keystore signs and verifies through a backend object. pure25519
+# always works (also on micropython), an accelerated module is used
+# if it is installed, passes the test vectors and is faster. The
+# choice can be overridden with select(name), or by setting the
+# environment variable TINYSSB_ED25519 to a backend name.
+#
+# a backend has these methods:
+#   signing_key(seed32, pk32=None)
+#                         -> obj with .vk_s (32B pubkey) and .sign(msg),
+#                            a known pk32 saves deriving it from the seed,
+#                            and .sign_many(msgs)
+#   signing_keys(seeds)   -> list of signing key objs
+#   verifying_key(pk32)   -> obj with .verify(sig, msg), raises if invalid
+#   verify_batch(items)   -> list of booleans, for a list of
+#                            (verifying_key_obj, sig, msg) tuples
+
+from collections import OrderedDict
+import os
+import time
+
+# ----------------------------------------------------------------------
+
+class PURE25519:
+
+    name = 'pure25519'
+
+    def __init__(self):
+        import pure25519
+        self.m = pure25519
+
+    def signing_key(self, seed, pk=None):
+        return self.m.SigningKey(seed + pk if pk else seed)
+
+    def signing_keys(self, seeds):
+        return [self.m.SigningKey(skvk)
+                for _, skvk in self.m.publickeys(seeds)]
+
+    def verifying_key(self, pk):
+        return self.m.VerifyingKey(pk)
+
+    def verify_batch(self, items):
+        return self.m.verify_batch(items)
+
+
+class _KEY: # adapter for the accelerated backends' key objects
+
+    def __init__(self, vk_s, sign=None, verify=None):
+        self.vk_s = vk_s
+        self._sign = sign
+        self._verify = verify
+        self._ref = None # pure25519 key, see verify()
+
+    def sign(self, msg):
+        return self._sign(msg)
+
+    def sign_many(self, msgs):
+        return [self._sign(m) for m in msgs]
+
+    def verify(self, sig, msg):
+        # libsodium and OpenSSL check [S]B-[h]A == R, pure25519 checks
+        # [8]([S]B-[h]A-R) == 0 (see pure25519.open()) and only accepts
+        # an A in the main subgroup. All backends must agree on which
+        # entries are valid: the key is checked once with pure25519, and
+        # a signature the library rejects gets a second (slow) chance.
+        if self._ref == None:
+            import pure25519
+            ref = pure25519.VerifyingKey(self.vk_s)
+            ref.element() # raises if A is not in the main subgroup
+            self._ref = ref
+        try:
+            self._verify(sig, msg)
+        except Exception:
+            self._ref.verify(sig, msg)
+
+
+class _ACCELERATED:
+
+    def signing_keys(self, seeds):
+        return [self.signing_key(s) for s in seeds]
+
+    def verify_batch(self, items):
+        lst = []
+        for vk, sig, msg in items:
+            try:
+                vk.verify(sig, msg)
+                lst.append(True)
+            except Exception:
+                lst.append(False)
+        return lst
+
+
+class PYNACL(_ACCELERATED): # libsodium
+
+    name = 'pynacl'
+
+    def __init__(self):
+        import nacl.signing
+        self.m = nacl.signing
+
+    def signing_key(self, seed, pk=None):
+        sk = self.m.SigningKey(seed)
+        return _KEY(bytes(sk.verify_key),
+                    sign=lambda msg: sk.sign(msg).signature)
+
+    def verifying_key(self, pk):
+        vk = self.m.VerifyKey(pk)
+        return _KEY(pk, verify=lambda sig, msg: vk.verify(msg, sig))
+
+
+class CRYPTOGRAPHY(_ACCELERATED): # OpenSSL
+
+    name = 'cryptography'
+
+    def __init__(self):
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        from cryptography.hazmat.primitives import serialization
+        self.m = ed25519
+        self.raw = (serialization.Encoding.Raw,
+                    serialization.PublicFormat.Raw)
+
+    def signing_key(self, seed, pk=None):
+        sk = self.m.Ed25519PrivateKey.from_private_bytes(seed)
+        return _KEY(sk.public_key().public_bytes(*self.raw), sign=sk.sign)
+
+    def verifying_key(self, pk):
+        vk = self.m.Ed25519PublicKey.from_public_bytes(pk)
+        return _KEY(pk, verify=vk.verify)
+
+# ----------------------------------------------------------------------
+
+L = 2**252 + 27742317777372353535851937790883648493 # group order
+
+# RFC 8032, section 7.1, tests 1 and 2: (seed, pk, msg, sig)
+TEST_VECTORS = [
+    ('9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60',
+     'd75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a',
+     '',
+     'e5564300c360ac729086e2cc806e828a84877f1eb8e5d974d873e06522490155'
+     '5fb8821590a33bacc61e39701cf9b46bd25bf5f0595bbe24655141438e7a100b'),
+    ('4ccd089b28ff96da9db6c346ec114e0f5b8a319f35aba624da8cf6ed4fb8a6fb',
+     '3d4017c3e843895a92b70aa74d1b7ebc9c982ccf2ec4968cc0cd55f12af4660c',
+     '72',
+     '92a009a9f0d4cab8720e820b5f642540a2b27b5416503f8fb3762223ebdb69da'
+     '085ac1e43e15996e458f3613d0f11d8c387b2eaeb4302aeeb00d291612bb0c00')
+]
+
+# signature of test 1's key whose R has a component of order 8: valid
+# with the cofactored equation (see pure25519.open()), must be accepted
+# by all backends, and in a batch: (pk, msg, sig)
+TORSION_VECTOR = (
+    'd75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a',
+    '74696e797373623a20522077697468206120736d616c6c2d6f7264657220636f'
+    '6d706f6e656e74',
+    '3ca40d9bdb2e49622cc48561a824a21b5d55215b5d5fae10264029508be9a2d4'
+    '6d45b4eee590da1887d95da4307dbd25bec5751070f64a461bb6ea24786b6501')
+
+def selftest(be):
+    # True if the backend reproduces the test vectors, incl. rejections
+    try:
+        for seed, pk, msg, sig in TEST_VECTORS:
+            seed, pk = bytes.fromhex(seed), bytes.fromhex(pk)
+            msg, sig = bytes.fromhex(msg), bytes.fromhex(sig)
+            sk = be.signing_key(seed)
+            if sk.vk_s != pk or sk.sign(msg) != sig:
+                return False
+            vk = be.verifying_key(pk)
+            vk.verify(sig, msg)
+            bad = sig[:-1] + bytes([sig[-1] ^ 0x01])
+            if be.verify_batch([(vk, sig, msg), (vk, bad, msg)]) != \
+                                                          [True, False]:
+                return False
+            try:
+                vk.verify(sig, msg + b'x')
+                return False
+            except Exception:
+                pass
+            # same signature with S+L instead of S: must be rejected,
+            # otherwise backends would disagree on which entries are valid
+            S = int.from_bytes(sig[32:], 'little') + L
+            bad = sig[:32] + S.to_bytes(32, 'little')
+            try:
+                vk.verify(bad, msg)
+                return False
+            except Exception:
+                pass
+            if be.verify_batch([(vk, sig, msg), (vk, bad, msg),
+                                (vk, sig, msg), (vk, sig, msg)]) != \
+                                              [True, False, True, True]:
+                return False
+        pk, msg, sig = [bytes.fromhex(x) for x in TORSION_VECTOR]
+        vk = be.verifying_key(pk)
+        vk.verify(sig, msg)
+        if be.verify_batch([(vk, sig, msg)] * 4) != [True] * 4:
+            return False
+        return True
+    except Exception:
+        return False
+
+def benchmark(be, cnt=5):
+    # returns the time (in sec) for cnt pairs of sign()+verify()
+    sk = be.signing_key(bytes(range(32)))
+    vk = be.verifying_key(sk.vk_s)
+    t = time.time()
+    for i in range(cnt):
+        msg = b'tinyssb-v0' + i.to_bytes(4, 'big') + bytes(56)
+        vk.verify(sk.sign(msg), msg)
+    return time.time() - t
+
+# ----------------------------------------------------------------------
+
+registry = OrderedDict() # name ~ backend class
+backend = None           # the selected backend object
+
+def register(cls):
+    registry[cls.name] = cls
+
+def available():
+    # list of backend objects that can be loaded and pass the self test
+    lst = []
+    for cls in registry.values():
+        try:
+            be = cls()
+        except Exception: # module not installed
+            continue
+        if selftest(be):
+            lst.append(be)
+    return lst
+
+def select(name=None):
+    # select the backend with the given name, or the fastest one
+    global backend
+    if name == None:
+        try:    name = os.environ.get('TINYSSB_ED25519')
+        except: pass # micropython has no os.environ
+    if name != None:
+        be = registry[name]()
+        if not selftest(be):
+            raise ValueError("ed25519 backend %s fails self test" % name)
+        backend = be
+        return backend
+    lst = available()
+    if len(lst) == 1:
+        backend = lst[0]
+    else:
+        backend = min(lst, key=benchmark)
+    return backend
+
+def get():
+    if backend == None:
+        select()
+    return backend
+
+register(PURE25519)
+register(PYNACL)
+register(CRYPTOGRAPHY)
+
+# eof
@@ -5,10 +5,46 @@
 
 import bipf
 from collections import OrderedDict
-import pure25519
+import os
 import sys
+import _thread
 
-from tinyssb import util
+from tinyssb import crypto, util
+
+# ----------------------------------------------------------------------
+
+class VerifyingKeyCache():
+    # bounded LRU of decoded public keys (verifying key objects of the
+    # crypto backend), keyed by feed ID: repeated verifications for the
+    # same feed then skip the point decompression
+
+    def __init__(self, size=512):
+        self.size = size
+        self.od = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.be = None
+
+    def get(self, pk):
+        be = crypto.get()
+        if be is not self.be: # backend was (re)selected
+            self.od.clear()
+            self.be = be
+        vk = self.od.pop(pk, None)
+        if vk == None:
+            self.misses += 1
+            vk = be.verifying_key(pk)
+            if len(self.od) >= self.size:
+                self.od.popitem(last=False) # least recently used
+        else:
+            self.hits += 1
+        self.od[pk] = vk # (re-)insert as most recently used
+        return vk
+
+    def clear(self):
+        self.od.clear()
+
+vk_cache = VerifyingKeyCache()
 
 # ----------------------------------------------------------------------
 
@@ -18,6 +54,12 @@ class Keystore():
         self.kv = OrderedDict()
         for pk,d in cfg.items():
             self.kv[util.fromhex(pk)] = [util.fromhex(d['sk']), d['name']]
+        self.sk_cache = {} # pk ~ signing key obj (with expanded secret)
+        self.pool = []     # pre-generated (pk, sk, signing key obj)
+        self.pool_depth = 0
+        self.pool_gen = 0  # a worker exits once this changes
+        self.pool_lock = _thread.allocate_lock()
+        self.pool_wakeup = _thread.allocate_lock() # released = wake up
 
     def dump(self, fn):
         # write DB to BIPF file
@@ -30,36 +72,97 @@ class Keystore():
         with open(fn, 'rb') as f:
             data = f.read()
         self.kv = bipf.loads(data)
+        self.sk_cache.clear()
     
     def new(self, nm=None):
-        # create new keypair
-        sk, _ = pure25519.create_keypair()
-        sk,pk = sk.sk_s[:32], sk.vk_s # just the bytes
-        self.add(pk, sk, nm)
+        # create new keypair, or take one from the pool
+        self.pool_lock.acquire()
+        kp = self.pool.pop(0) if len(self.pool) > 0 else None
+        self.pool_lock.release()
+        if kp == None:
+            sk = os.urandom(32)
+            pk = crypto.get().signing_key(sk).vk_s
+            self.add(pk, sk, nm)
+        else:
+            self._wakeup_pool()
+            pk, sk, skobj = kp
+            self.add(pk, sk, nm)
+            self.sk_cache[pk] = skobj
         return pk
 
+    def start_pool(self, depth=4):
+        # pre-generate up to depth keypairs in a background thread, such
+        # that new() (e.g. for continuation feeds) does not stall a writer
+        if self.pool_depth > 0: # already running: refill to the new depth
+            self.pool_depth = depth
+            self._wakeup_pool()
+            return
+        self.pool_depth = depth
+        self.pool_gen += 1
+        _thread.start_new_thread(self._pool_loop, (self.pool_gen,))
+
+    def stop_pool(self):
+        self.pool_depth = 0
+        self.pool_gen += 1
+        self._wakeup_pool()
+
+    def _wakeup_pool(self):
+        try:    self.pool_wakeup.release()
+        except: pass # worker is already awake
+
+    def _pool_loop(self, gen):
+        while gen == self.pool_gen:
+            while gen == self.pool_gen and len(self.pool) < self.pool_depth:
+                seeds = [os.urandom(32)
+                         for i in range(self.pool_depth - len(self.pool))]
+                skobjs = crypto.get().signing_keys(seeds) # bulk creation
+                self.pool_lock.acquire()
+                for sk, skobj in zip(seeds, skobjs):
+                    self.pool.append((skobj.vk_s, sk, skobj))
+                self.pool_lock.release()
+            self.pool_wakeup.acquire() # sleep until new() takes a key
+        self._wakeup_pool() # in case a restarted worker waits for it
+
     def add(self, pk, sk=None, nm=None):
         self.kv[pk] = [sk,nm]
+        if pk in self.sk_cache: del self.sk_cache[pk]
 
     def remove(self, pk):
         del self.kv[pk]
+        if pk in self.sk_cache: del self.sk_cache[pk]
+
+    def _signing_key(self, pk):
+        # keeps the expanded signing state, instead of rehashing the seed
+        # and recomputing the public key for each signature
+        if not pk in self.sk_cache:
+            sk = crypto.get().signing_key(self.kv[pk][0], pk)
+            self.sk_cache[pk] = sk
+        return self.sk_cache[pk]
 
     def sign(self, pk, msg):
-        sk = pure25519.SigningKey(self.kv[pk][0])
-        return sk.sign(msg)
+        return self._signing_key(pk).sign(msg)
+
+    def sign_many(self, pk, msgs):
+        # returns the list of signatures for a list of messages
+        return self._signing_key(pk).sign_many(msgs)
 
     def get_signFct(self, pk):
-        return mksignfct(self.kv[pk][0])
+        return self._signing_key(pk).sign
 
     def verify(self, pk, sig, msg):
         try:
-            pure25519.VerifyingKey(pk).verify(sig,msg)
+            vk_cache.get(pk).verify(sig,msg)
             return True
         except Exception as e:
             print(e)
             pass
         return False
 
+    def verify_batch(self, items):
+        # items is a list of (pk, sig, msg), returns a list of booleans
+        return crypto.get().verify_batch([(vk_cache.get(pk), sig, msg)
+                                          for pk, sig, msg in items])
+
     def __str__(self):
         out = OrderedDict()
         for pk,(sk,nm) in self.kv.items():
@@ -67,20 +170,26 @@ class Keystore():
         return util.json_pp(out)
         
 def mksignfct(secret):
-    def sign(m):
-        sk = pure25519.SigningKey(secret)
-        return sk.sign(m)
-    return sign
+    sk = crypto.get().signing_key(secret)
+    return sk.sign
+
+def verify_signature(pk, s, msg):
+    # module-level (i.e. picklable) such that it can run in a process pool
+    try:
+        vk_cache.get(pk).verify(s,msg)
+        return True
+    except Exception as e:
+        print(e)
+        pass
+    return False
 
 def mkverifyfct(secret):
-    def vfct(pk, s, msg):
-        try:
-            pure25519.VerifyingKey(pk).verify(s,msg)
-            return True
-        except Exception as e:
-            print(e)
-            pass
-        return False
-    return vfct
+    return verify_signature
+
+def mkverifybatchfct():
+    def bfct(items): # list of (pk, sig, msg) -> list of booleans
+        return crypto.get().verify_batch([(vk_cache.get(pk), sig, msg)
+                                          for pk, sig, msg in items])
+    return bfct
 
 # eof
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# tinyssb/msgindex.py  -- repository-wide index of log entries
+
+'''
+Maps the message ID, the DMX and the proof value (last 12B of the wire,
+as used by ischild/iscontn genesis blocks) of every stored log entry to
+its (fid, seq). Lives in the repo's _index directory:
+
+  feeds     32B per feed, the feed number is the position in the file
+  entries   47B per entry: feed number (4B) + seq (4B) + MID (20B)
+            + DMX (7B) + proof (12B). seq 0 means: forget all entries
+            of that feed so far, see drop()
+
+Both files are only appended to, and loaded into dicts at startup. The
+index can lag behind the logs after a crash (see front()), or hold
+entries that were dropped from a log since: the REPO checks each hit
+against the log, and can drop a feed's entries or clear() them all.
+'''
+
+import os
+import _thread
+
+REC = 47
+
+class MSGINDEX:
+
+    def __init__(self, path):
+        self.path = path
+        try: os.mkdir(path)
+        except: pass
+        self.lock = _thread.allocate_lock()
+        self.fids = []   # feed number ~ fid
+        self.fnr = {}    # fid ~ feed number
+        self.mid = {}    # MID ~ (fnr, seq, dmx)
+        self.dmx = {}    # DMX ~ (fnr, seq, dmx)
+        self.proof = {}  # proof ~ (fnr, seq, dmx)
+        self.fronts = {} # fnr ~ (seq, MID) of the highest indexed entry
+        self._load()
+        self.ff = open(self.path + '/feeds', 'ab')
+        self.ef = open(self.path + '/entries', 'ab')
+
+    def _load(self):
+        fn = self.path + '/feeds'
+        try:
+            with open(fn, 'rb') as f: buf = f.read()
+        except:
+            buf = b''
+        for i in range(0, len(buf) - 31, 32):
+            self.fnr[buf[i:i+32]] = len(self.fids)
+            self.fids.append(buf[i:i+32])
+        if len(buf) % 32 != 0: # torn last record
+            with open(fn, 'wb') as f: f.write(buf[:32*len(self.fids)])
+        fn = self.path + '/entries'
+        try:
+            with open(fn, 'rb') as f: buf = f.read()
+        except:
+            buf = b''
+        n = 0
+        for i in range(0, len(buf) - REC + 1, REC):
+            fnr = int.from_bytes(buf[i:i+4], 'big')
+            if fnr >= len(self.fids): break # feed record got lost
+            seq = int.from_bytes(buf[i+4:i+8], 'big')
+            if seq == 0:
+                self._drop(fnr)
+            else:
+                self._put(fnr, seq, buf[i+8:i+28], buf[i+28:i+35],
+                          buf[i+35:i+47])
+            n += 1
+        if len(buf) != n * REC:
+            with open(fn, 'wb') as f: f.write(buf[:n * REC])
+
+    def _put(self, fnr, seq, mid, dmx, proof):
+        v = (fnr, seq, dmx)
+        self.mid[mid] = v
+        self.dmx[dmx] = v
+        self.proof[proof] = v
+        if seq > self.fronts.get(fnr, (0,))[0]:
+            self.fronts[fnr] = (seq, mid)
+
+    def add(self, fid, entries):
+        # entries: list of (seq, mid, wire) of one feed, in one write
+        with self.lock:
+            fnr = self.fnr.get(fid, None)
+            if fnr == None:
+                fnr = len(self.fids)
+                self.ff.write(fid)
+                self.ff.flush()
+                self.fnr[fid] = fnr
+                self.fids.append(fid)
+            buf = []
+            for seq, mid, wire in entries:
+                mid, dmx, proof = bytes(mid), bytes(wire[:7]), bytes(wire[-12:])
+                buf.append(fnr.to_bytes(4, 'big') + seq.to_bytes(4, 'big') +
+                           mid + dmx + proof)
+                self._put(fnr, seq, mid, dmx, proof)
+            self.ef.write(b''.join(buf))
+            self.ef.flush()
+
+    def drop(self, fid):
+        # forgets all entries of a feed, e.g. if its log went back to an
+        # older front than the index has
+        with self.lock:
+            fnr = self.fnr.get(fid, None)
+            if fnr == None: return
+            self.ef.write(fnr.to_bytes(4, 'big') + bytes(REC - 4))
+            self.ef.flush()
+            self._drop(fnr)
+
+    def _drop(self, fnr):
+        for d in [self.mid, self.dmx, self.proof]:
+            for k in [k for k, v in d.items() if v[0] == fnr]:
+                del d[k]
+        self.fronts.pop(fnr, None)
+
+    def front(self, fid):
+        # (seq, MID) of the feed's highest indexed entry, or None
+        fnr = self.fnr.get(fid, None)
+        return None if fnr == None else self.fronts.get(fnr, None)
+
+    def _get(self, d, key): # -> (fid, seq, dmx), or None
+        v = d.get(bytes(key), None)
+        return None if v == None else (self.fids[v[0]], v[1], v[2])
+
+    def by_mid(self, mid):     return self._get(self.mid, mid)
+    def by_dmx(self, dmx):     return self._get(self.dmx, dmx)
+    def by_proof(self, proof): return self._get(self.proof, proof)
+
+    def clear(self):
+        with self.lock:
+            self.ff.close()
+            self.ef.close()
+            for fn in ['feeds', 'entries']:
+                try:    os.remove(self.path + '/' + fn)
+                except: pass
+            self.fids, self.fnr, self.fronts = [], {}, {}
+            self.mid, self.dmx, self.proof = {}, {}, {}
+            self.ff = open(self.path + '/feeds', 'ab')
+            self.ef = open(self.path + '/entries', 'ab')
+
+# eof
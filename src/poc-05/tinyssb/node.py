@@ -13,7 +13,7 @@ from .dbg import *
 
 class NODE:  # a node in the tinySSB forwarding fabric
 
-    def __init__(self, faces, keystore, repo, me, peerlst):
+    def __init__(self, faces, keystore, repo, me, peerlst, verify_workers=0):
         self.faces = faces
         self.ks = keystore
         self.repo  = repo
@@ -29,9 +29,21 @@ class NODE:  # a node in the tinySSB forwarding fabric
         self.pending_chains = []
         self.next_timeout = [0]
         self.ndlock = _thread.allocate_lock()
+        # optional verification pipeline (a pool of worker processes):
+        self.vworkers = verify_workers
+        self.vpool = None
+        self.vqueue = None # (result, dmx, repo, feed, pkt) in arrival order
+        self.vpending = {} # wire bytes of packets being verified
+        self.vlock = _thread.allocate_lock()
 
 
     def start(self):
+        if self.vworkers > 0: # create workers before we have threads
+            import multiprocessing, queue
+            self.vpool = multiprocessing.Pool(self.vworkers)
+            self.vqueue = queue.Queue()
+            print(f"  starting thread with commit loop, {self.vworkers} verifiers")
+            _thread.start_new_thread(self.commit_loop, tuple())
         self.ioloop = io.IOLOOP(self.faces, self.on_rx)
         print('  starting thread with IO loop')
         _thread.start_new_thread(self.ioloop.run, tuple())
@@ -145,7 +157,56 @@ class NODE:  # a node in the tinySSB forwarding fabric
 
     def incoming_logentry(self, d, repo, feed, buf, n):
         # dbg(GRA, f'RCV pkt@dmx={util.hex(d)}, try to append it')
+        if self.vpool != None:
+            seq, prev = feed.getfront()
+            self.submit_logentry(d, repo, feed, buf, seq+1, prev)
+            return
         pkt = feed.append(buf) # this invokes the callback
+        self.logentry_appended(d, repo, feed, pkt)
+
+    def submit_logentry(self, d, repo, feed, buf, seq, prev):
+        # hand the signature check to the process pool; the commit loop
+        # appends the packets in arrival (hence sequence) order
+        from tinyssb import keystore
+        if feed.ctx.dmx(seq, prev) != buf[:7]:
+            return # handler is stale
+        self.vlock.acquire()
+        if buf in self.vpending: # duplicate, is already being verified
+            self.vlock.release()
+            return
+        pkt = packet.from_bytes(buf, feed.fid, seq, prev, None, feed.ctx)
+        r = self.vpool.apply_async(keystore.verify_signature,
+                                   (feed.fid, pkt.signature,
+                                    pkt.nam + buf[:56]))
+        self.vpending[buf] = True
+        self.vqueue.put((r, d, repo, feed, pkt))
+        self.vlock.release()
+        # already accept the next entry, it can be verified in parallel:
+        pktdmx = feed.ctx.dmx(seq+1, pkt.mid)
+        self.ndlock.acquire()
+        self.arm_dmx(pktdmx,
+                     lambda buf,n: self.submit_logentry(pktdmx, repo, feed,
+                                                        buf, seq+1, pkt.mid),
+                     f"{util.hex(feed.fid)[:20]}.[{seq+1}] /pipelined")
+        self.ndlock.release()
+
+    def commit_loop(self): # the single writer of the verification pipeline
+        while True:
+            r, d, repo, feed, pkt = self.vqueue.get()
+            ok = r.get()
+            self.vlock.acquire()
+            del self.vpending[pkt.wire]
+            self.vlock.release()
+            if not ok:
+                dbg(RED, "    verification failed")
+                continue
+            # None if it does not chain to the front (stale, or its
+            # predecessor failed to verify):
+            pkt = feed.append_pkt(pkt)
+            if pkt != None:
+                self.logentry_appended(d, repo, feed, pkt)
+
+    def logentry_appended(self, d, repo, feed, pkt):
         self.ndlock.acquire()
         if pkt == None:
             self.ndlock.release()
@@ -175,7 +236,7 @@ class NODE:  # a node in the tinySSB forwarding fabric
             newFeed = repo.allocate_log(newFID, 0, newFID[:20]) # install cont.
             dbg(GRE, f'    new child is {util.hex(newFID)[:20]}..')
             newFeed.set_append_cb(oldfeed.acb)
-            pktdmx = packet._dmx(newFID + int(1).to_bytes(4, 'big') + newFID[:20])
+            pktdmx = newFeed.ctx.dmx(1, newFID[:20])
             # dbg(GRA, f"+dmx pkt@{util.hex(pktdmx)} for {util.hex(newFID)[:20]}.[1] /mkchild")
             self.arm_dmx(pktdmx,
                          lambda buf,n: self.incoming_logentry(pktdmx, repo,
@@ -191,8 +252,7 @@ class NODE:  # a node in the tinySSB forwarding fabric
         #         oldfeed = None
         seq, prevhash = feed.getfront()
         seq += 1
-        nextseq = seq.to_bytes(4, 'big')
-        pktdmx = packet._dmx(feed.fid + nextseq + prevhash)
+        pktdmx = feed.ctx.dmx(seq, prevhash)
         # dbg(GRA, f"+dmx pkt@{util.hex(pktdmx)} for {util.hex(feed.fid)[:20]}.[{seq}] /incoming")
         self.arm_dmx(pktdmx,
                      lambda buf,n: self.incoming_logentry(pktdmx, repo,
@@ -231,7 +291,7 @@ class NODE:  # a node in the tinySSB forwarding fabric
         seq, prevhash = feed.getfront()
         seq += 1
         nextseq = seq.to_bytes(4, 'big')
-        pktdmx = packet._dmx(feed.fid + nextseq + prevhash)
+        pktdmx = feed.ctx.dmx(seq, prevhash)
         # dbg(GRA, f"+dmx pkt@{util.hex(pktdmx)} for {util.hex(feed.fid)[:20]}.[{seq}]")
         self.arm_dmx(pktdmx,
                         lambda buf,n: self.incoming_logentry(pktdmx, repo,
@@ -284,7 +344,10 @@ class NODE:  # a node in the tinySSB forwarding fabric
                         continue
                     feed = self.repo.get_log(fid)
                     self.ndlock.acquire()
-                    if feed[-1].typ[0] == packet.PKTTYPE_contdas:
+                    # an empty log (just allocated, or all entries
+                    # dropped) has no last entry: feed[-1] would raise
+                    if len(feed) > feed.anchrS and \
+                       feed[-1].typ[0] == packet.PKTTYPE_contdas:
                         # this is a terminated feed, don't ask for news
                         self.ndlock.release()
                         continue
@@ -20,12 +20,40 @@ PFX = b'tinyssb-v0'
 def _dmx(fsp): # fsp = feedID/seqNo/prevMsgID
     return hashlib.sha256(PFX + fsp).digest()[:7]
 
+class FEEDCTX: # per-feed hashing context
+
+    def __init__(self, fid):
+        # keeps a SHA256 object that has already absorbed PFX+fid: all
+        # DMX and MID hashes of this feed continue from a copy of it
+        self.fid = fid
+        self.h = hashlib.sha256(PFX + fid)
+        self.can_copy = hasattr(self.h, 'copy') # not in micropython
+
+    def _hash(self, data):
+        if self.can_copy:
+            h = self.h.copy()
+            h.update(data)
+            return h.digest()
+        return hashlib.sha256(PFX + self.fid + data).digest()
+
+    def dmx(self, seq, prev):
+        return self._hash(seq.to_bytes(4,'big') + prev)[:7]
+
+    def mid(self, seq, prev, wire):
+        return self._hash(seq.to_bytes(4,'big') + prev + wire)[:20]
+
 class PACKET:
 
-    def __init__(self, fid, seq, prev):
+    def __init__(self, fid, seq, prev, ctx=None, dmx=None):
         self.fid, self.seq, self.prev = fid, seq, prev
+        self.ctx = ctx
         self.nam = PFX + self.fid + self.seq.to_bytes(4,'big') + self.prev
-        self.dmx = hashlib.sha256(self.nam).digest()[:7]
+        if dmx: # known from the wire, no need to hash
+            self.dmx = dmx
+        elif ctx:
+            self.dmx = ctx.dmx(seq, prev)
+        else:
+            self.dmx = hashlib.sha256(self.nam).digest()[:7]
         self.typ = None
         self.payload = None
         self.signature = None
@@ -37,6 +65,8 @@ class PACKET:
         self.chain_nextptr = None # hashptr of next (pending) blob
 
     def _mid(self):
+        if self.ctx:
+            return self.ctx.mid(self.seq, self.prev, self.wire)
         return hashlib.sha256(self.nam + self.wire).digest()[:20]
 
     def _sign(self, typ, payload, signFct):
@@ -49,6 +79,8 @@ class PACKET:
         self.mid = self._mid()
         
     def predict_next_dmx(self):
+        if self.ctx:
+            return self.ctx.dmx(self.seq+1, self.mid)
         next_name = PFX + self.fid + (self.seq+1).to_bytes(4,'big') + self.mid
         return hashlib.sha256(next_name).digest()[:7]
 
@@ -79,7 +111,7 @@ class PACKET:
 
     def mk_chain(self, content, signFct):
         # fills in and signs this object, returns reversed list of blobs
-        # FIXME: use hardisk instead of memory?
+        # (for large content, use mk_chain_stream() instead)
         sz = btc_var_int(len(content))
         buf = sz + content
         ptr = bytes(20)
@@ -102,46 +134,180 @@ class PACKET:
         blobs.reverse()
         return blobs
 
+    def mk_chain_stream(self, f, size, addBlobFct, signFct):
+        # same as mk_chain() but for size bytes read from the seekable
+        # file f: the blobs are built back to front and handed one by
+        # one to addBlobFct, only the hashptr to the next blob is kept
+        start = f.tell()
+        sz = btc_var_int(size)
+        first = min(size, 28 - len(sz)) # content bytes in the log entry
+        tail = size - first
+        ptr = bytes(20)
+        i = (tail + 99) // 100
+        while i > 0:
+            i -= 1
+            f.seek(start + first + 100*i)
+            buf = f.read(min(100, tail - 100*i))
+            buf += bytes(100-len(buf)) + ptr
+            addBlobFct(buf)
+            ptr = blob2hashptr(buf)
+        f.seek(start)
+        head = sz + f.read(first)
+        self._sign(PKTTYPE_chain20, head + bytes(28-len(head)) + ptr, signFct)
+
     def undo_chain(self, getBlobFct):
         if self.chain_len < 0:
             self.chain_len, sz = btc_var_int_decode(self.payload)
-            self.chain_content = self.payload[sz:min(28,sz+self.chain_len)]
+            self.chain_content = bytes(self.payload[sz:min(28,sz+self.chain_len)])
             if self.chain_len == len(self.chain_content):
                 self.chain_firstptr = None
             else:
-                self.chain_firstptr = self.payload[-20:]
+                self.chain_firstptr = bytes(self.payload[-20:])
             if self.chain_firstptr == bytes(20):
                 self.chain_firstptr = None
             self.chain_nextptr = self.chain_firstptr
         # print("undo_chain", self.chain_len, len(self.chain_content), self.chain_nextptr.hex())
-        while getBlobFct and self.chain_len > len(self.chain_content) \
-                         and self.chain_nextptr:
+        have = len(self.chain_content)
+        parts = [self.chain_content]
+        while getBlobFct and self.chain_len > have and self.chain_nextptr:
             blob = getBlobFct(self.chain_nextptr)
             if blob == None:
                 # print("no blob :-(")
-                return False
+                break
             self.chain_nextptr = blob[100:]
             if self.chain_nextptr == bytes(20): self.chain_nextptr = None
-            blob = blob[:min(100,self.chain_len - len(self.chain_content))]
+            blob = blob[:min(100,self.chain_len - have)]
             # print("blob!", len(blob), blob)
-            self.chain_content += blob
-            # print("lengths", self.chain_len, len(self.chain_content))
+            parts.append(blob)
+            have += len(blob)
+        if len(parts) > 1:
+            self.chain_content = b''.join(parts)
         return self.chain_len == len(self.chain_content) # all content found
 
+
+class CHAINREADER:
+    # file-like access to the content of a chain20 entry: the hashptr
+    # chain is walked lazily via getBlobFct, one 100B blob at a time.
+    # If a blob is not (yet) available, read() and the iterator stop
+    # early and can be called again later, e.g. after missing() arrived
+
+    def __init__(self, pkt, getBlobFct):
+        self.get = getBlobFct
+        self.size, sz = btc_var_int_decode(pkt.payload)
+        self.buf = bytes(pkt.payload[sz:min(28,sz+self.size)])
+        self.fetched = len(self.buf) # content bytes taken from the chain
+        self.pos = 0                 # content bytes returned so far
+        self.nextptr = None
+        if self.fetched < self.size:
+            self.nextptr = bytes(pkt.payload[-20:])
+            if self.nextptr == bytes(20): self.nextptr = None
+
+    def _fetch(self):
+        if self.fetched >= self.size or self.nextptr == None:
+            return False
+        blob = self.get(self.nextptr)
+        if blob == None:
+            return False
+        self.nextptr = blob[100:]
+        if self.nextptr == bytes(20): self.nextptr = None
+        self.buf = blob[:min(100,self.size - self.fetched)]
+        self.fetched += len(self.buf)
+        return True
+
+    def missing(self): # hashptr of the blob needed to continue, or None
+        return self.nextptr if self.fetched < self.size else None
+
+    def is_complete(self):
+        return self.pos == self.size
+
+    def __iter__(self):
+        while len(self.buf) > 0 or self._fetch():
+            chunk, self.buf = self.buf, b''
+            self.pos += len(chunk)
+            yield chunk
+
+    def read(self, n=-1):
+        parts = []
+        while n != 0 and (len(self.buf) > 0 or self._fetch()):
+            chunk = self.buf if n < 0 else self.buf[:n]
+            self.buf = self.buf[len(chunk):]
+            self.pos += len(chunk)
+            parts.append(chunk)
+            if n > 0: n -= len(chunk)
+        return b''.join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class PKTVIEW:
+    # read-only packet as returned from a log: keeps a single reference
+    # to the 120B wire buffer, the fields are memoryview slices of it,
+    # and nam/mid are only hashed if someone asks for them
+
+    __slots__ = ('fid', 'seq', 'prev', 'ctx', 'wire', '_nam', '_mid',
+                 'chain_len', 'chain_content',
+                 'chain_firstptr', 'chain_nextptr')
+
+    def __init__(self, buf120, fid, seq, prev, ctx=None):
+        self.fid, self.seq, self.prev = fid, seq, prev
+        self.ctx = ctx
+        self.wire = memoryview(buf120)
+        self._nam = None
+        self._mid = None
+        self.chain_len = -1
+        self.chain_content = b''
+        self.chain_firstptr = None
+        self.chain_nextptr = None
+
+    @property
+    def dmx(self):       return self.wire[:7]
+    @property
+    def typ(self):       return self.wire[7:8]
+    @property
+    def payload(self):   return self.wire[8:56]
+    @property
+    def signature(self): return self.wire[56:]
+
+    @property
+    def nam(self):
+        if self._nam == None:
+            self._nam = PFX + self.fid + self.seq.to_bytes(4,'big') + self.prev
+        return self._nam
+
+    @property
+    def mid(self): #  only valid if `prev was correct
+        if self._mid == None:
+            if self.ctx:
+                self._mid = self.ctx.mid(self.seq, self.prev, self.wire)
+            else:
+                self._mid = hashlib.sha256(self.nam + self.wire).digest()[:20]
+        return self._mid
+
+    predict_next_dmx = PACKET.predict_next_dmx
+    has_sidechain = PACKET.has_sidechain
+    content_is_complete = PACKET.content_is_complete
+    get_content = PACKET.get_content
+    undo_chain = PACKET.undo_chain
+
 # ----------------------------------------------------------------------
 
 def blob2hashptr(blob):
     return hashlib.sha256(blob).digest()[:20]
 
-def from_bytes(buf120, fid, seq, prev, verify_signature_fct):
+def from_bytes(buf120, fid, seq, prev, verify_signature_fct, ctx=None):
     # converts bytes to a packet object, if it verifies or if flag is False
-    pkt = PACKET(fid, seq, prev)
+    if type(buf120) != bytes: # e.g. the wire of a PKTVIEW
+        buf120 = bytes(buf120)
     if verify_signature_fct: # expected DMX value
+        pkt = PACKET(fid, seq, prev, ctx)
         if pkt.dmx != buf120[:7]:
             print("DMX verify failed, not a valid log extension")
             return None
     else:
-        pkt.dmx = buf120[:7]
+        pkt = PACKET(fid, seq, prev, ctx, buf120[:7])
     pkt.typ = buf120[7:8]
     pkt.payload = buf120[8:56]
     pkt.signature = buf120[56:]
@@ -171,6 +337,15 @@ def btc_var_int_decode(buf):
     assert len(buf) >= 9
     return (int.from_bytes(buf[1:9], 'little'), 9)
 
+def chain_blobs(payload):
+    # (hashptr of the first blob, number of blobs) of a chain20 payload,
+    # or None if all content is in the payload itself
+    size, sz = btc_var_int_decode(payload)
+    tail = size - min(size, 28 - sz)
+    ptr = bytes(payload[-20:])
+    if tail <= 0 or ptr == bytes(20): return None
+    return (ptr, (tail + 99) // 100)
+
 # ----------------------------------------------------------------------
 
 '''
@@ -11,24 +11,34 @@ directory structure of a repository:
       +--> _logs
       |       +--> FID1_IN_HEX.log
       |       `--> FID2_IN_HEX.log
-      `--> _blob
-              +--> 05/REST_OF_HASHPTR1_IN_HEX
-              +--> 05/REST_OF_HASHPTR2_IN_HEX
-              `--> AA/REST_OF_HASHPTR3_IN_HEX
+      +--> _blob
+      |       +--> pack-0000
+      |       +--> pack-0001
+      |       `--> pack.idx
+      `--> _cache
+              `--> HASH_OF_CHAIN20_PAYLOAD_IN_HEX
 
-blobs: stored as files of length 120 (!)
+blobs: 120B records in pack files, see blobstore.py (or, with
+       blob_store='dir', as files of length 120 in _blob/XX/)
 logs: see end of this file for a description of the log file format,
       it's a multiple of 128B
+cache: reassembled content of complete sidechains (can be deleted)
+index: MID/DMX/proof ~ (fid, seq), see msgindex.py (can be deleted)
 '''
 
+from collections import OrderedDict
 import hashlib
 import os
 import sys
+import time
+import _thread
 
-from tinyssb import packet, util
+from tinyssb import blobstore, msgindex, packet, util
 from tinyssb.dbg import *
 
 if sys.implementation.name == 'micropython':
+    mmap = None
+    pread = None
     def isfile(fn):
         try:    return os.stat(fn)[0] & 0x8000 != 0
         except: return False
@@ -36,31 +46,86 @@ if sys.implementation.name == 'micropython':
         try:    return os.stat(fn)[0] & 0x4000 != 0
         except: return False
 else:
+    import mmap
+    pread = getattr(os, 'pread', None) # not on Windows
     isfile = os.path.isfile
     isdir  = os.path.isdir
 
+def fsync(f):
+    f.flush()
+    try:    os.fsync(f.fileno())
+    except: pass # e.g. micropython: flush() is all we have
+
+# durability policies for appending to logs
+SYNC_OS    = 0 # entries and header are flushed to the OS (default)
+SYNC_FSYNC = 1 # entries, then header, are fsync'ed on every append
+SYNC_GROUP = 2 # group commit: header update and fsync only every
+               # group_n entries or group_ms milliseconds, whatever
+               # comes first. A crash loses at most these entries.
+
 class REPO:
 
-    def __init__(self, path, verify_signature_fct):
+    def __init__(self, path, verify_signature_fct, verify_batch_fct=None,
+                 cache_bytes=16*1024*1024,
+                 sync=SYNC_OS, group_n=32, group_ms=50, max_open=256,
+                 blob_store='pack', blob_cache_bytes=1024*1024):
         self.path = path
         self.vfct = verify_signature_fct
+        self.bfct = verify_batch_fct
+        self.sync = (sync, group_n, group_ms)
         try: os.mkdir(self.path + '/_logs')
         except: pass
         try: os.mkdir(self.path + '/_blob')
         except: pass
+        blobdir = blobstore.BLOBDIR(self.path + '/_blob')
+        if blob_store == 'dir':
+            self.blobs = blobstore.BLOBCACHE(blobdir, blob_cache_bytes)
+        else:
+            pack = blobstore.BLOBPACK(self.path + '/_blob')
+            n = pack.migrate(blobdir) # from an older repo
+            if n > 0: print("moved", n, "blobs to the pack store")
+            self.blobs = blobstore.BLOBCACHE(pack, blob_cache_bytes)
         self.open_logs = {}
+        # LOG objects stay in open_logs, but only the most recently used
+        # max_open of them keep their file (and mapping) open
+        self.max_open = max_open
+        self.fh_lru = OrderedDict() # fid ~ LOG with an open file
+        self.fh_lock = _thread.allocate_lock()
+        self.chain_cache = CHAINCACHE(self.path + '/_cache', cache_bytes)
+        self.chain_lock = _thread.allocate_lock() # see BLOBGC
+        self.gc_young = None  # blobs added while a BLOBGC runs
+        self.gc_due = False   # a log was deleted since the last BLOBGC
+        self.blob_refs = None # hptr ~ refcount, see enable_blob_refs()
+        self.ref_pending = {} # missing hptr ~ list of remaining lengths
+        self.ref_lock = _thread.allocate_lock()
+        self.retention = (None, None) # see set_retention()
+        self.index = None     # see enable_index()
+        if sync == SYNC_GROUP:
+            _thread.start_new_thread(self._commit_loop, tuple())
+
+    def _commit_loop(self):
+        # enforces the group_ms deadline when no further appends come
+        while True:
+            time.sleep(self.sync[2] / 1000)
+            for feed in list(self.open_logs.values()):
+                try:
+                    feed.commit(False)
+                except Exception as e: # e.g. a full disk: keep the thread
+                    print("group commit failed", util.hex(feed.fid)[:20], e)
+
+    def commit(self):
+        # makes all appended log entries durable, e.g. before shutdown
+        for feed in list(self.open_logs.values()):
+            feed.commit()
 
     def _log_fn(self, fid):
         return self.path + '/_logs/' + util.hex(fid) + '.log'
 
-    def _blob_fn(self, hashval):
-        h = util.hex(hashval)
-        return self.path + '/_blob/' + h[:2] + '/' + h[2:]
-
     def listlog(self):
         lst = []
         for fn in os.listdir(self.path + '/_logs/'):
-            lst.append(util.fromhex(fn.split('.')[0]))
+            if fn.endswith('.log'):
+                lst.append(util.fromhex(fn.split('.')[0]))
         return lst
 
     def allocate_log(self, fid, trusted_seq, trusted_msgID,
@@ -122,46 +187,340 @@ class REPO:
         if not fid in self.open_logs:
             fn = self._log_fn(fid)
             if not isfile(fn): return None
-            l = LOG(fn, self.vfct)
+            l = LOG(fn, self.vfct, self.bfct, *self.sync)
             if l == None: return None
+            l.on_open = self._log_opened
+            l.on_append = self._log_appended
             self.open_logs[fid] = l
-        return self.open_logs[fid]
+            self._log_opened(l)
+            if self.index != None:
+                self._index_catchup(l)
+            return l
+        l = self.open_logs[fid]
+        with self.fh_lock:
+            if self.fh_lru.pop(fid, None) != None:
+                self.fh_lru[fid] = l # most recently used
+        return l
+
+    # repository-wide index of all stored entries, by message ID, DMX
+    # and proof (last 12B of the wire, as in ischild/iscontn genesis
+    # blocks). Kept up to date by the LOGs' on_append hook.
+
+    def enable_index(self):
+        self.index = msgindex.MSGINDEX(self.path + '/_index')
+        for fid in self.listlog():
+            feed = self.get_log(fid) # catches up on newly opened logs
+            if feed != None:
+                self._index_catchup(feed)
+
+    def rebuild_index(self):
+        self.index.clear()
+        for fid in self.listlog():
+            feed = self.get_log(fid)
+            if feed != None:
+                self._index_catchup(feed)
+
+    def _index_catchup(self, feed):
+        # indexes the entries that the index does not know yet, e.g.
+        # after a crash, or for a log created with allocate_log()
+        front = self.index.front(feed.fid)
+        if front != None and front[0] > feed.anchrS and \
+                                  not self._index_front_ok(feed, *front):
+            # the log was recovered (or recreated) to an older front
+            self.index.drop(feed.fid)
+            front = None
+        if front == None or front[0] <= feed.anchrS:
+            front = (feed.anchrS, feed.anchrM)
+        seq, mid = front
+        lst = []
+        for w in feed.read_range(seq+1, feed.frontS+1):
+            seq += 1
+            mid = feed.ctx.mid(seq, mid, w)
+            lst.append((seq, mid, w))
+        if len(lst) > 0:
+            self.index.add(feed.fid, lst)
+
+    def _index_front_ok(self, feed, seq, mid):
+        # True if the log has the index's front entry: the log's front
+        # itself, or the MID predicts the DMX of the log's next entry
+        if seq > feed.frontS: return False
+        if seq == feed.frontS: return mid == feed.frontM
+        w = feed.read_range(seq+1, seq+2)
+        return len(w) == 1 and feed.ctx.dmx(seq+1, mid) == w[0][:7]
+
+    def _index_check(self, hit): # -> (fid, seq) if still in the log
+        if hit == None: return None
+        fid, seq, dmx = hit
+        feed = self.get_log(fid)
+        if feed == None: return None
+        w = feed.read_range(seq, seq+1)
+        if len(w) != 1 or w[0][:7] != dmx: return None
+        return (fid, seq)
+
+    def find_mid(self, mid):     return self._index_check(self.index.by_mid(mid))
+    def find_dmx(self, dmx):     return self._index_check(self.index.by_dmx(dmx))
+    def find_proof(self, proof): return self._index_check(self.index.by_proof(proof))
+
+    def _log_opened(self, feed):
+        with self.fh_lock:
+            self.fh_lru.pop(feed.fid, None)
+            self.fh_lru[feed.fid] = feed
+            busy = []
+            while len(self.fh_lru) > self.max_open:
+                fid, l = self.fh_lru.popitem(last=False)
+                # a log that is busy writing (maybe waiting for fh_lock
+                # itself) stays open, until a later eviction
+                if not l.close(False):
+                    busy.append((fid, l))
+            for fid, l in busy:
+                self.fh_lru[fid] = l
+
+    def _log_appended(self, pkts): # called by a LOG, see on_append
+        if self.blob_refs != None:
+            self._refs_add([p.wire for p in pkts])
+        if self.index != None and len(pkts) > 0:
+            self.index.add(pkts[0].fid, [(p.seq, p.mid, p.wire) for p in pkts])
 
     def del_log(self, fid):
+        if self.blob_refs != None:
+            feed = self.get_log(fid)
+            if feed != None:
+                self._refs_drop(feed.read_range(1, feed.frontS+1))
+                self.blobs.compact(False)
         if fid in self.open_logs:
             feed = self.open_logs[fid]
-            feed.f.close()
+            with self.fh_lock:
+                self.fh_lru.pop(fid, None)
+            feed.close()
             del self.open_logs[fid]
         fn = self._log_fn(fid)
         os.unlink(fn)
+        self.gc_due = True
 
     def add_blob(self, buf120):
         hptr = hashlib.sha256(buf120).digest()[:20]
-        fn = self._blob_fn(hptr)
-        dn = fn[:-39]
-        if not isdir(dn):   os.mkdir(dn)
-        if isfile(fn):      return
-        with open(fn, "wb+") as f:  f.write(buf120)
+        self.blobs.add(hptr, buf120)
+        if self.gc_young != None:
+            self.gc_young.add(hptr)
+        if self.blob_refs != None and hptr in self.ref_pending:
+            with self.ref_lock:
+                for cnt in self.ref_pending.pop(hptr, []):
+                    self._ref_walk(hptr, cnt)
         return hptr
 
+    def _chain_walk(self, hptr, cnt):
+        # follows a sidechain from blob hptr for at most cnt blobs,
+        # returns the list of stored blobs and, if one is missing,
+        # (its hptr, remaining cnt)
+        lst = []
+        while cnt > 0 and hptr != None:
+            blob = self.blobs.get(hptr)
+            if blob == None:
+                return lst, (hptr, cnt)
+            lst.append(hptr)
+            hptr = blob[100:]
+            if hptr == bytes(20): hptr = None
+            cnt -= 1
+        return lst, None
+
+    def _chains(self, wires): # (first hptr, cnt) for all chain20 entries
+        for w in wires:
+            if w[7] == packet.PKTTYPE_chain20:
+                c = packet.chain_blobs(w[8:56])
+                if c: yield c
+
+    # reference counting of blobs, an optional fast path to the BLOBGC:
+    # the blobs of a log's sidechains are freed right when the log is
+    # deleted (or truncated), if no other sidechain uses them.
+    # Chains whose blobs are still missing are counted as they arrive.
+
+    def enable_blob_refs(self):
+        with self.ref_lock:
+            self.blob_refs, self.ref_pending = {}, {}
+        for fid in self.listlog():
+            feed = self.get_log(fid)
+            if feed != None:
+                self._refs_add(feed.read_range(1, feed.frontS+1))
+
+    def _ref_walk(self, hptr, cnt): # caller must hold ref_lock
+        lst, stop = self._chain_walk(hptr, cnt)
+        for h in lst:
+            self.blob_refs[h] = self.blob_refs.get(h, 0) + 1
+        if stop:
+            self.ref_pending.setdefault(stop[0], []).append(stop[1])
+
+    def _refs_add(self, wires):
+        with self.ref_lock:
+            for hptr, cnt in self._chains(wires):
+                self._ref_walk(hptr, cnt)
+
+    def _refs_drop(self, wires):
+        with self.ref_lock:
+            for hptr, cnt in self._chains(wires):
+                lst, stop = self._chain_walk(hptr, cnt)
+                if stop and stop[1] in self.ref_pending.get(stop[0], []):
+                    self.ref_pending[stop[0]].remove(stop[1])
+                for h in lst:
+                    n = self.blob_refs.get(h, 0) - 1
+                    if n > 0:
+                        self.blob_refs[h] = n
+                    else:
+                        self.blob_refs.pop(h, None)
+                        self.blobs.remove(h)
+
+    def truncate_log(self, fid, seq):
+        # LOG.truncate_before(), then drop the blob references of the
+        # entries that were actually removed
+        feed = self.get_log(fid)
+        if feed == None: return 0
+        dropped = []
+        cnt = feed.truncate_before(seq, dropped)
+        if cnt > 0:
+            if self.blob_refs != None:
+                self._refs_drop(dropped)
+            self.gc_due = True
+        return cnt
+
+    def set_retention(self, entries=None, nbytes=None):
+        # keep at most this many entries, or bytes of entries, per log
+        self.retention = (entries, nbytes)
+
+    def apply_retention(self):
+        # truncates the logs according to set_retention(), returns the
+        # number of dropped entries. A log is only rewritten once it has
+        # a quarter more entries (at least 16) than it should keep.
+        lst = [n for n in (self.retention[0],
+                           None if self.retention[1] == None
+                                else self.retention[1] // 128) if n != None]
+        if len(lst) == 0: return 0
+        keep = min(lst)
+        cnt = 0
+        for fid in self.listlog():
+            feed = self.get_log(fid)
+            if feed == None: continue
+            if feed.frontS - feed.anchrS - keep < max(16, keep // 4):
+                continue
+            cnt += self.truncate_log(fid, feed.frontS - keep + 1)
+        return cnt
+
+    def start_retention(self, period=600):
+        def loop():
+            while True:
+                self.apply_retention()
+                time.sleep(period)
+        _thread.start_new_thread(loop, tuple())
+
+    def start_blob_gc(self, period=3600, steps=100, pause=0.01):
+        # background BLOBGC, every period seconds or soon after a log
+        # was deleted, in small steps to not starve the other threads
+        def loop():
+            last = 0
+            while True:
+                if self.gc_due or time.time() - last >= period:
+                    self.gc_due = False
+                    last = time.time()
+                    gc = BLOBGC(self)
+                    while not gc.step(steps):
+                        time.sleep(pause)
+                time.sleep(1)
+        _thread.start_new_thread(loop, tuple())
+
     def get_blob(self, hashptr):
-        try:
-            with open(self._blob_fn(hashptr), "rb") as f: return f.read(120)
-        except Exception as e:
-            # print("get_blob", e)
-            pass
-        return None
+        return self.blobs.get(hashptr)
+
+    def chain_reader(self, pkt):
+        # streams the content of a chain20 entry, see packet.CHAINREADER
+        return packet.CHAINREADER(pkt, self.get_blob)
+
+    def read_chain(self, pkt, offset=0, n=-1):
+        # random access to the content of a complete chain20 entry,
+        # None if blobs are still missing
+        return self.chain_cache.read(pkt, self.get_blob, offset, n)
+
+    def map_chain(self, pkt):
+        # read-only mmap of a complete chain20 entry's content
+        return self.chain_cache.map(pkt, self.get_blob)
+
+    def ingest(self, fid, buf120):
+        # trusted bulk restore: the entry goes to the log's quarantine at
+        # disk speed, its signature is checked later by verify_quarantine()
+        feed = self.get_log(fid)
+        if feed == None: return None
+        pkt = feed.ingest(buf120)
+        young = self.gc_young
+        if pkt != None and young != None: # log may be marked already
+            for c in self._chains([pkt.wire]):
+                young.update(self._chain_walk(*c)[0])
+        return pkt
+
+    def verify_quarantine(self, batch=64):
+        # promotes (or discards) quarantined entries of all open logs,
+        # returns the number of entries that were verified
+        cnt = 0
+        for feed in list(self.open_logs.values()):
+            while len(feed.quar) > 0:
+                n = len(feed.quar[:batch])
+                feed.promote(batch)
+                cnt += n
+        return cnt
+
+    def start_verifier(self, batch=64, period=0.1):
+        # background thread that runs verify_quarantine() periodically
+        def loop():
+            while True:
+                if self.verify_quarantine(batch) == 0:
+                    time.sleep(period)
+        _thread.start_new_thread(loop, tuple())
 
     def persist_chain(self, pkt, blobs):
         # first persist the blobs as otherwise we could have stored the
         # log entry but not all blobs, in case of a node crash
-        for b in blobs:
-            self.add_blob(b)
-        feed = self.get_log(pkt.fid)
-        # should we check our own signature here, use feed.append(pkt.wire)?
-        feed._append(pkt)
+        with self.chain_lock:
+            for b in blobs:
+                self.add_blob(b)
+            feed = self.get_log(pkt.fid)
+            # should we check our own signature here, use feed.append(pkt.wire)?
+            if feed._append(pkt) == None: return None
         return [pkt.wire] + blobs
         
+    def write_chain(self, fid, src, signfct, size=None):
+        # streams content into a new chain20 entry of log fid, src is a
+        # file object or an iterator of byte chunks: the blobs go to the
+        # blob store as they are built, the log entry is appended last.
+        # Content that cannot be seeked is spooled to disk first.
+        feed = self.get_log(fid)
+        if feed == None: return None
+        spool, sf = None, None
+        try:
+            if not hasattr(src, 'seek') or not hasattr(src, 'read'):
+                # unique name: concurrent calls for the same feed
+                spool = self.path + '/_spool-' + util.hex(fid)[:20] + \
+                        '-' + util.hex(os.urandom(4))
+                with open(spool, 'wb') as f:
+                    for chunk in src:
+                        f.write(chunk)
+                src = sf = open(spool, 'rb')
+                size = None
+            self.chain_lock.acquire() # blobs and entry, not split by BLOBGC
+            try:
+                if size == None:
+                    start = src.tell()
+                    src.seek(0, 2)
+                    size = src.tell() - start
+                    src.seek(start)
+                pkt = packet.PACKET(fid, feed.frontS+1, feed.frontM, feed.ctx)
+                pkt.mk_chain_stream(src, size, self.add_blob, signfct)
+                if feed._append(pkt) == None: pkt = None
+            finally:
+                self.chain_lock.release()
+        finally:
+            if sf != None:
+                sf.close()
+            if spool != None:
+                try:    os.remove(spool)
+                except: pass # the iterator failed before it was created
+        return pkt
+
     '''
     def get_peer(fid): # -> PEER
         pass
@@ -177,10 +536,18 @@ class REPO:
 
 class LOG:
 
-    def __init__(self, fn, verify_signature_fct):
-        # self.fn = fn
+    def __init__(self, fn, verify_signature_fct, verify_batch_fct=None,
+                 sync=SYNC_OS, group_n=32, group_ms=50, full_scan=False):
+        self.fn = fn
         self.vfct = verify_signature_fct
-        self.f = open(fn, 'rb+')
+        self.bfct = verify_batch_fct # (pk,sig,msg) list -> list of bool
+        self.sync = sync
+        self.group_n, self.group_ms = group_n, group_ms
+        self.dirty = 0   # appended entries not yet covered by the header
+        self.dirty_t = 0 # time of the oldest of them
+        self._f = open(fn, 'rb+')
+        self.on_open = None # set by the REPO, see the f property
+        self.on_append = None # set by the REPO, called with new packets
         self.f.seek(0)
         hdr = self.f.read(128)
         hdr = hdr[12:]                                # first 12B unused
@@ -191,59 +558,451 @@ class LOG:
         self.anchrM = hdr[72:92]                        # trusted msgID
         self.frontS = int.from_bytes(hdr[92:96], 'big') # seqNr of last rec
         self.frontM = hdr[96:116]                       # msgID of last rec
-        self.f.seek(0, 2)
-        assert self.f.tell() == 128 + 128 * (self.frontS - self.anchrS), \
-               "log file length mismatch"
+        self.ctx = packet.FEEDCTX(self.fid)
         self.acb = None # append callback
         self.subscription = 0
+        # quarantine: ingested entries, written to the file after the
+        # front but not yet verified, nor covered by the header's front
+        self.quar = []
+        self.qlock = _thread.allocate_lock()
+        self.wlock = _thread.allocate_lock() # serializes all file writes
+        self.mm = None  # read-only mapping of the file, if mmap exists
+        self.hlock = _thread.allocate_lock() # guards _f, mm and users
+        self.users = {} # file handle ~ number of readers using it
+        self.gen = 0    # incremented twice by truncate_before()
+        try:    os.remove(fn + '.new') # left over from truncate_before()
+        except: pass
+        self.f.seek(0, 2)
+        if full_scan or self.f.tell() != 128 + 128 * (self.frontS - self.anchrS):
+            self._recover(full_scan)
+
+    def _recover(self, full_scan):
+        # after a crash, the file can have a torn last record, entries
+        # beyond the header's front (group commit, interrupted ingest),
+        # or a header front beyond the stored entries. We walk the
+        # DMX/MID chain, normally starting at the header's front, from
+        # the anchor if full_scan is set or the front is not in the file,
+        # cut the file after the last valid entry and repair the front.
+        self.f.seek(0, 2)
+        have = self.anchrS + (self.f.tell() - 128) // 128 # last full entry
+        if full_scan or self.frontS > have:
+            seq, prev = self.anchrS, self.anchrM
+        else:
+            seq, prev = self.frontS, self.frontM
+        pkts = [] # entries beyond the old front, signature not checked
+        while seq < have:
+            self.f.seek(128 * (seq + 1 - self.anchrS))
+            buf = self.f.read(128 * min(256, have - seq))
+            for i in range(0, len(buf), 128):
+                wire = buf[i+8:i+128]
+                if self.ctx.dmx(seq+1, prev) != wire[:7]:
+                    have = seq # chain broken, ignore the rest
+                    break
+                pkt = packet.from_bytes(wire, self.fid, seq+1, prev,
+                                        None, self.ctx)
+                if pkt.seq > self.frontS:
+                    pkts.append(pkt)
+                seq, prev = pkt.seq, pkt.mid
+        if len(pkts) > 0:
+            items = [(p.fid, p.signature, p.nam + p.wire[:56]) for p in pkts]
+            if self.bfct != None and len(items) > 1:
+                oks = self.bfct(items)
+            elif self.vfct != None:
+                oks = [self.vfct(*i) for i in items]
+            else: # cannot verify, drop them
+                oks = [False] * len(items)
+            if False in oks:
+                p = pkts[oks.index(False)]
+                seq, prev = p.seq - 1, p.prev
+        print("log recovery for", util.hex(self.fid)[:20],
+              "front", self.frontS, "->", seq)
+        self.f.truncate(128 + 128 * (seq - self.anchrS))
+        self._header(seq, prev)
+        self.frontS, self.frontM = seq, prev
+
+    @property
+    def f(self): # the log file, reopened if it was closed by close()
+        f = self._f
+        if f == None:
+            with self.hlock:
+                f = self._f
+                opened = f == None
+                if opened:
+                    f = open(self.fn, 'rb+')
+                    self._f = f
+            if opened and self.on_open != None: # can evict other logs
+                self.on_open(self)
+        return f
+
+    # Writers use the handle under wlock. Readers do not take wlock (it
+    # is held during fsync, promote() and truncate_before()), but count
+    # themselves as users of the handle: a handle dropped by close() or
+    # truncate_before() is closed by its last reader, see _unuse().
+
+    def _use(self):
+        while True:
+            f = self.f
+            with self.hlock:
+                if self._f is f: # not dropped in between
+                    self.users[f] = self.users.get(f, 0) + 1
+                    return f
+
+    def _unuse(self, f):
+        with self.hlock:
+            n = self.users[f] - 1
+            if n > 0:
+                self.users[f] = n
+                return
+            del self.users[f]
+            if f is not self._f:
+                f.close()
+
+    def _drop_handle(self): # under wlock and hlock
+        f, self._f, self.mm = self._f, None, None
+        if f != None:
+            f.flush() # a later reader must not miss buffered writes
+            if not f in self.users:
+                f.close()
+
+    def close(self, blocking=True):
+        # releases the file handle and the mapping, the LOG object with
+        # its front, acb and subscription stays valid and reopens the
+        # file when needed. The handle is closed explicitly (micropython
+        # does not free it), once its last user is done. A reader that
+        # still has the old mapping can continue to use it. Returns
+        # False if not blocking and the log is busy.
+        if not self.wlock.acquire(blocking):
+            return False
+        try:
+            if not self.hlock.acquire(blocking):
+                return False
+            try:
+                self._drop_handle()
+            finally:
+                self.hlock.release()
+        finally:
+            self.wlock.release()
+        return True
+
+    def _remap(self):
+        # the file grew beyond the mapping: map it again, a reader that
+        # still holds the old mapping can continue to use it
+        f = self._use()
+        try:
+            size = os.fstat(f.fileno())[6]
+            with self.hlock:
+                mm = self.mm
+                if mm == None or size > len(mm):
+                    mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                    if self._f is f:
+                        self.mm = mm
+        finally:
+            self._unuse(f)
+        return mm
+
+    def _read(self, pos, cnt):
+        # positional read, readers never move the writer's file position
+        if mmap:
+            mm = self.mm
+            if mm == None or pos + cnt > len(mm):
+                mm = self._remap()
+            if pos + cnt <= len(mm):
+                return mm[pos:pos+cnt]
+        if pread:
+            f = self._use()
+            try:
+                return pread(f.fileno(), cnt, pos)
+            finally:
+                self._unuse(f)
+        with self.wlock: # the file position is shared with the writer
+            f = self.f
+            f.seek(pos)
+            return f.read(cnt)
 
     def __getitem__(self, seq):
         if seq > self.frontS: raise IndexError
         if seq < 0:
             seq = self.frontS + seq + 1
             if seq < 0: raise IndexError
-        pos = 128 * (seq - self.anchrS)
-        self.f.seek(pos)
-        buf = self.f.read(128)[8:]
-        if not buf or len(buf) == 0: return None
-        mid = self.anchrM if seq == self.anchrS + 1 else bytes(20)
-        return packet.from_bytes(buf, self.fid, seq, mid, None)
+        def rd():
+            if seq <= self.anchrS: return None # dropped, or seq == 0
+            buf = self._read(128 * (seq - self.anchrS), 128)
+            return (buf, self.anchrS, self.anchrM)
+        r = self._stable(rd)
+        if r == None: raise IndexError
+        buf, anchrS, anchrM = r
+        if not buf or len(buf) <= 8: return None
+        mid = anchrM if seq == anchrS + 1 else bytes(20)
+        return packet.PKTVIEW(memoryview(buf)[8:], self.fid, seq, mid, self.ctx)
+
+    def read_range(self, lo, hi):
+        # wire bytes (120B each) of the entries lo..hi-1, as far as stored
+        def rd():
+            l = max(lo, self.anchrS + 1)
+            h = min(hi, self.frontS + 1)
+            if l >= h: return b''
+            return self._read(128 * (l - self.anchrS), 128 * (h - l))
+        buf = self._stable(rd)
+        return [buf[i+8:i+128] for i in range(0, len(buf) - 127, 128)]
+
+    def _stable(self, rd):
+        # runs the read function until no truncate_before() replaced the
+        # file in between (a seqlock: gen is odd while it does so)
+        while True:
+            gen = self.gen
+            if gen & 1 == 0:
+                val = rd()
+                if gen == self.gen: return val
+            else:
+                time.sleep(0.001)
 
     def __len__(self):
         return self.frontS
 
     def __del__(self):
-        self.f.close()
+        if self.mm: self.mm.close()
+        try:    self.commit()
+        except: pass # file was already removed by del_log()
+        if self._f: self._f.close()
 
     def _append(self, pkt):
-        assert pkt.seq == self.frontS + 1, "new log entry not in sequence"
-        # append to file:
-        self.f.seek(0,2)
-        self.f.write(bytes(8) + pkt.wire)
-        # update file header:
-        self.frontS += 1
-        self.frontM = pkt.mid
-        self.f.seek(12+92) # position of front fields
-        self.f.write(self.frontS.to_bytes(4, 'big') + self.frontM)
-        self.f.flush()
-        # os.fsync(self.f.fileno())
+        with self.wlock:
+            assert pkt.seq == self.frontS + 1, "new log entry not in sequence"
+            if not self._write([pkt]): return None
         return pkt
 
+    def _write(self, pkts): # caller must hold wlock
+        # returns False (and writes nothing) while ingested entries wait
+        # in the quarantine: their place in the file comes first
+        if len(self.quar) > 0:
+            print("log has quarantined entries, append rejected")
+            return False
+        # append to file, all entries with a single write:
+        f = self.f
+        f.seek(0,2)
+        f.write(b''.join([bytes(8) + p.wire for p in pkts]))
+        last = pkts[-1]
+        if self.sync == SYNC_GROUP:
+            f.flush() # readers can see it, header comes later
+            if self.dirty == 0: self.dirty_t = time.time()
+            self.dirty += len(pkts)
+            if self.dirty >= self.group_n:
+                self._header(last.seq, last.mid)
+        else:
+            if self.sync == SYNC_FSYNC: # entries before the header
+                fsync(f)
+            self._header(last.seq, last.mid)
+        # readers see the new front only once the entry is in the file
+        self.frontM = last.mid
+        self.frontS = last.seq
+        if self.on_append != None:
+            self.on_append(pkts)
+        return True
+
+    def _header(self, seq, mid): # caller must hold wlock
+        f = self.f
+        if self.sync == SYNC_GROUP and self.dirty > 0:
+            fsync(f)
+        f.seek(12+92) # position of front fields
+        f.write(seq.to_bytes(4, 'big') + mid)
+        if self.sync == SYNC_OS:
+            f.flush()
+        else:
+            fsync(f)
+        self.dirty = 0
+
+    def commit(self, force=True):
+        # group commit: writes the front to the header and fsyncs, if
+        # forced or if the oldest uncommitted entry is due
+        with self.wlock:
+            if self.dirty == 0: return
+            if force or time.time() - self.dirty_t >= self.group_ms / 1000:
+                self._header(self.frontS, self.frontM)
+
     def append(self, buf120):
         pkt = packet.from_bytes(buf120, self.fid, self.frontS+1, self.frontM,
-                                self.vfct)
+                                self.vfct, self.ctx)
         if pkt == None: return None
-        self._append(pkt)
+        if self._append(pkt) == None: return None
         if self.acb != None:
             self.acb(pkt)
         return pkt
 
+    def append_pkt(self, pkt):
+        # appends an already verified packet object, if it chains to the
+        # front (used by the node's verification pipeline)
+        with self.wlock:
+            if pkt.seq != self.frontS+1 or pkt.prev != self.frontM:
+                return None
+            if not self._write([pkt]): return None
+        if self.acb != None:
+            self.acb(pkt)
+        return pkt
+
+    def append_many(self, buf120_lst):
+        # appends consecutive entries, returns the list of appended packets.
+        # The DMX chain is checked entry by entry, the signatures of all
+        # entries are verified in one go if we have a batch verify fct.
+        # Stops at the first entry that does not verify.
+        pkts = []
+        seq, prev = self.frontS, self.frontM
+        for buf in buf120_lst:
+            seq += 1
+            if self.ctx.dmx(seq, prev) != buf[:7]:
+                print("DMX verify failed, not a valid log extension")
+                break
+            pkt = packet.from_bytes(buf, self.fid, seq, prev, None, self.ctx)
+            pkts.append(pkt)
+            prev = pkt.mid
+        oks = None
+        if self.bfct != None and len(pkts) > 1:
+            oks = self.bfct([(p.fid, p.signature, p.nam + p.wire[:56])
+                             for p in pkts])
+        for i in range(len(pkts)):
+            p = pkts[i]
+            ok = oks[i] if oks else self.vfct(p.fid, p.signature,
+                                              p.nam + p.wire[:56])
+            if not ok:
+                print("signature verify failed")
+                pkts = pkts[:i]
+                break
+        if len(pkts) == 0: return pkts
+        with self.wlock:
+            assert pkts[0].seq == self.frontS + 1, "new log entry not in sequence"
+            if not self._write(pkts): return []
+        if self.acb != None:
+            for p in pkts:
+                self.acb(p)
+        return pkts
+
+    def ingest(self, buf120):
+        # appends the entry to the quarantine, checking only the DMX
+        # (i.e. the prev/mid hash chain) now and the signature later
+        self.qlock.acquire()
+        if len(self.quar) > 0:
+            seq, prev = self.quar[-1].seq, self.quar[-1].mid
+        else:
+            seq, prev = self.frontS, self.frontM
+        seq += 1
+        if self.ctx.dmx(seq, prev) != buf120[:7]:
+            self.qlock.release()
+            print("DMX verify failed, not a valid log extension")
+            return None
+        pkt = packet.from_bytes(buf120, self.fid, seq, prev, None, self.ctx)
+        with self.wlock:
+            f = self.f
+            f.seek(0,2)
+            f.write(bytes(8) + pkt.wire)
+            self.quar.append(pkt) # under wlock, see _write()
+        self.qlock.release()
+        return pkt
+
+    def promote(self, cnt=64):
+        # verifies the oldest cnt quarantined entries as one batch and
+        # moves the front over them. At the first bad signature, the
+        # quarantine is discarded and the file truncated after the front.
+        # Returns the list of promoted packets.
+        # qlock is held throughout: a concurrent promote() (e.g. by the
+        # verifier thread and verify_quarantine()) must neither promote
+        # nor drop entries that this call has verified, or not.
+        self.qlock.acquire()
+        pkts = self.quar[:cnt]
+        if len(pkts) == 0:
+            self.qlock.release()
+            return []
+        items = [(p.fid, p.signature, p.nam + p.wire[:56]) for p in pkts]
+        try:
+            if self.bfct != None and len(items) > 1:
+                oks = self.bfct(items)
+            else:
+                oks = [self.vfct(*i) for i in items]
+        except:
+            self.qlock.release()
+            raise
+        good = 0
+        while good < len(pkts) and oks[good]:
+            good += 1
+        self.wlock.acquire()
+        f = self.f
+        if good > 0:
+            if self.sync != SYNC_OS: # the entries are already in the file
+                fsync(f)
+            self._header(pkts[good-1].seq, pkts[good-1].mid)
+            self.frontM = pkts[good-1].mid
+            self.frontS = pkts[good-1].seq
+            if self.on_append != None:
+                self.on_append(pkts[:good])
+        if good < len(pkts):
+            print("signature verify failed, truncating log", self.frontS)
+            f.truncate(128 + 128 * (self.frontS - self.anchrS))
+            self.mm = None
+            self.quar = []
+        else:
+            self.quar = self.quar[len(pkts):]
+        f.flush()
+        self.wlock.release()
+        self.qlock.release()
+        if self.acb != None:
+            for p in pkts[:good]:
+                self.acb(p)
+        return pkts[:good]
+
+    def truncate_before(self, seq, dropped=None):
+        # drops the entries before seq: the others are copied to a new
+        # file with seq-1 as its anchor, which then atomically replaces
+        # the log file. Returns the number of dropped entries, and adds
+        # their wire bytes to the list dropped, if given. A log with
+        # quarantined entries is left as is until they are promoted.
+        with self.wlock:
+            if len(self.quar) > 0: return 0
+            seq = min(seq, self.frontS + 1)
+            if seq <= self.anchrS + 1: return 0
+            f = self.f
+            f.flush()
+            # msgID of the new anchor, by following the chain up to it
+            s, mid = self.anchrS, self.anchrM
+            while s < seq - 1:
+                f.seek(128 * (s + 1 - self.anchrS))
+                buf = f.read(128 * min(256, seq - 1 - s))
+                for i in range(0, len(buf), 128):
+                    s += 1
+                    mid = self.ctx.mid(s, mid, buf[i+8:i+128])
+                    if dropped != None:
+                        dropped.append(buf[i+8:i+128])
+            tmp = self.fn + '.new'
+            with open(tmp, 'wb') as nf:
+                f.seek(0)
+                hdr = f.read(128)
+                nf.write(hdr[:80] + (seq-1).to_bytes(4, 'big') + mid +
+                         self.frontS.to_bytes(4, 'big') + self.frontM)
+                pos = 128 * (seq - self.anchrS)
+                end = 128 * (self.frontS + 1 - self.anchrS)
+                while pos < end:
+                    f.seek(pos)
+                    buf = f.read(min(128*1024, end - pos))
+                    nf.write(buf)
+                    pos += len(buf)
+                fsync(nf)
+            self.gen += 1 # readers wait
+            try:
+                os.rename(tmp, self.fn)
+            except: # e.g. FAT on micropython: cannot rename over a file
+                os.remove(self.fn)
+                os.rename(tmp, self.fn)
+            with self.hlock: # the new file is opened on next access
+                self._drop_handle()
+            cnt = seq - 1 - self.anchrS
+            self.anchrS, self.anchrM = seq - 1, mid
+            self.dirty = 0
+            self.gen += 1
+        return cnt
+
     def write_plain_48B(self, buf48, signfct):
         return self.write_typed_48B(packet.PKTTYPE_plain48, buf48, signfct)
 
     def write_typed_48B(self, typ, buf48, signfct):
         assert len(buf48) == 48
-        e = packet.PACKET(self.fid, self.frontS+1, self.frontM)
+        e = packet.PACKET(self.fid, self.frontS+1, self.frontM, self.ctx)
         e.mk_typed_entry(typ, buf48, signfct)
         return self.append(e.wire)
 
@@ -251,7 +1010,7 @@ class LOG:
         return self.write_typed_48B(packet.PKTTYPE_contdas, bytes(48), signfct)
 
     def prepare_chain(self, buf, signfct): # returns list of packets, or None
-        e = packet.PACKET(self.fid, self.frontS+1, self.frontM)
+        e = packet.PACKET(self.fid, self.frontS+1, self.frontM, self.ctx)
         blobs = e.mk_chain(buf, signfct)
         return e, blobs
 
@@ -263,6 +1022,169 @@ class LOG:
 
 # ----------------------------------------------------------------------
 
+class BLOBGC:
+    # mark-and-sweep of the blob store: blobs that cannot be reached
+    # from a chain20 entry of a stored log (incl. its quarantine) are
+    # removed. The work is done
+    # in small steps, see step(), so that it can run in the background.
+    # With dry_run, only the list of removable blobs is collected.
+
+    def __init__(self, repo, dry_run=False):
+        self.repo = repo
+        self.dry_run = dry_run
+        self.blobs = 0     # number of blobs when we started
+        self.marked = 0    # ... of which reachable
+        self.garbage = []  # hptrs that were (or would be) removed
+        self.done = False
+        self.work = self._run()
+
+    def _run(self):
+        repo = self.repo
+        with repo.chain_lock: # no sidechain is half written now
+            cand = list(repo.blobs)
+            repo.gc_young = set()
+        self.blobs = len(cand)
+        live = set()
+        try:
+            for fid in repo.listlog(): # mark
+                feed = repo.get_log(fid)
+                if feed == None: continue
+                seq = feed.anchrS + 1
+                while seq <= feed.frontS:
+                    for c in repo._chains(feed.read_range(seq, seq+64)):
+                        live.update(repo._chain_walk(*c)[0])
+                    seq += 64
+                    yield
+                # not yet verified, but their blobs are needed once they are
+                for c in repo._chains([p.wire for p in feed.quar]):
+                    live.update(repo._chain_walk(*c)[0])
+            self.marked = len(live)
+            for i in range(len(cand)): # sweep
+                h = cand[i]
+                if h in live or h in repo.gc_young: continue
+                self.garbage.append(h)
+                if not self.dry_run:
+                    repo.blobs.remove(h)
+                    if repo.blob_refs != None:
+                        with repo.ref_lock:
+                            repo.blob_refs.pop(h, None)
+                if i % 256 == 255: yield
+        finally:
+            repo.gc_young = None
+        if not self.dry_run and len(self.garbage) > 0:
+            repo.blobs.compact(False)
+        self.done = True
+
+    def step(self, n=1): # returns True when done
+        try:
+            for i in range(n):
+                next(self.work)
+        except StopIteration:
+            pass
+        return self.done
+
+    def run(self):
+        while not self.step(100):
+            pass
+        return self.report()
+
+    def report(self):
+        return {'blobs': self.blobs, 'reachable': self.marked,
+                'garbage': len(self.garbage),
+                'bytes': 120 * len(self.garbage), 'dry_run': self.dry_run}
+
+# ----------------------------------------------------------------------
+
+class CHAINCACHE:
+    # reassembled content of complete sidechains, one file per chain,
+    # so that a read does not have to follow the hashptrs blob by blob.
+    # The files are named after the hash of the chain20 payload (which
+    # determines the content) and are evicted LRU beyond maxbytes.
+
+    def __init__(self, path, maxbytes):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.lru = OrderedDict() # hex name ~ content size
+        self.total = 0
+        self.lock = _thread.allocate_lock()
+        try: os.mkdir(self.path)
+        except: pass
+        for fn in os.listdir(self.path):
+            if fn.endswith('.tmp'): # left over from a crash
+                os.remove(self.path + '/' + fn)
+                continue
+            sz = os.stat(self.path + '/' + fn)[6]
+            self.lru[fn] = sz
+            self.total += sz
+        self._evict()
+
+    def _evict(self):
+        # the most recent entry is kept even if it alone exceeds maxbytes
+        while self.total > self.maxbytes and len(self.lru) > 1:
+            fn, sz = self.lru.popitem(last=False) # least recently used
+            self.total -= sz
+            try:    os.remove(self.path + '/' + fn)
+            except: pass
+
+    def _open(self, pkt, getBlobFct):
+        # returns the content file, opened for reading, None if
+        # incomplete. Lookup and open happen under the lock, so an
+        # eviction cannot remove the file in between.
+        fn = util.hex(packet.blob2hashptr(bytes(pkt.payload)))
+        with self.lock:
+            sz = self.lru.pop(fn, None)
+            if sz != None:
+                try:
+                    f = open(self.path + '/' + fn, 'rb')
+                    self.lru[fn] = sz # most recently used
+                    return f
+                except OSError: # removed behind our back: fill it again
+                    self.total -= sz
+        rd = packet.CHAINREADER(pkt, getBlobFct)
+        # concurrent fills of the same chain each use their own tmp file
+        tmp = self.path + '/' + fn + '.' + str(_thread.get_ident())
+        try:    tmp += '-' + str(os.getpid()) + '.tmp'
+        except: tmp += '.tmp' # micropython has no getpid()
+        with open(tmp, 'wb') as f:
+            for chunk in rd:
+                f.write(chunk)
+        if not rd.is_complete():
+            os.remove(tmp)
+            return None
+        with self.lock:
+            try:
+                os.rename(tmp, self.path + '/' + fn)
+            except: # FAT: a concurrent fill was first, same content
+                os.remove(tmp)
+            if self.lru.pop(fn, None) == None:
+                self.total += rd.size
+            self.lru[fn] = rd.size
+            f = open(self.path + '/' + fn, 'rb')
+            self._evict() # keeps fn, the most recent entry
+        return f
+
+    def read(self, pkt, getBlobFct, offset=0, n=-1):
+        rd = packet.CHAINREADER(pkt, getBlobFct)
+        if rd.missing() == None: # no blobs, content is in the log entry
+            data = rd.read()
+            if not rd.is_complete(): return None
+            return data[offset:] if n < 0 else data[offset:offset+n]
+        f = self._open(pkt, getBlobFct)
+        if f == None: return None
+        with f:
+            f.seek(offset)
+            return f.read(n)
+
+    def map(self, pkt, getBlobFct):
+        # None if incomplete, empty or if mmap is not available
+        f = self._open(pkt, getBlobFct) if mmap else None
+        if f == None: return None
+        with f:
+            if f.seek(0, 2) == 0: return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# ----------------------------------------------------------------------
+
 '''
 A) Internal structure of an append-only log file:
 
@@ -78,13 +78,13 @@ class SlidingWindow:
     def _process(self, pkt):
         # print("SESS _processing")
         if pkt.typ == bytes([packet.PKTTYPE_contdas]):
-            self.rfd = self.nd.repo.get_log(pkt.payload[:32])
+            self.rfd = self.nd.repo.get_log(bytes(pkt.payload[:32]))
             self.nd.repo.del_log(pkt.fid)
             return
         if pkt.typ[0] == packet.PKTTYPE_iscontn:
             # dbg(GRE, f"SESS: processing iscontn")
             # should verify proof
-            oldFID = pkt.payload[:32]
+            oldFID = bytes(pkt.payload[:32])
             msg = oldFID # + ??
             self.write_typed_48B(packet.PKTTYPE_acknldg,
                                  msg + bytes(48-len(msg)))
@@ -96,8 +96,9 @@ class SlidingWindow:
                 return
             dbg(GRE, f"SESS: removing feed {util.hex(self.pfd)[:20]}..")
             f = self.nd.repo.get_log(self.pfd)
-            if len(f) > 1 and f[-1].typ[0] == packet.PKTTYPE_contdas:
-                self.pfd = f[-1].payload[:32]
+            if len(f) > max(1, f.anchrS) and \
+               f[-1].typ[0] == packet.PKTTYPE_contdas:
+                self.pfd = bytes(f[-1].payload[:32])
             else:
                 self.pfd = None
             self.nd.repo.del_log(f.fid)
@@ -107,7 +108,7 @@ class SlidingWindow:
         if pkt.typ[0] == packet.PKTTYPE_plain48:
             # print("sliding: doing upcall")
             if self.upcall != None:
-                self.upcall(pkt.payload)
+                self.upcall(bytes(pkt.payload))
         
     def set_upcall(self, upcall):
         self.upcall = upcall